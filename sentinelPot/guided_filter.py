@@ -6,6 +6,8 @@ Maintainer: Lei Song (lsong@clarku.edu)
 """
 import os
 import sys
+import multiprocessing as mp
+from threading import Lock
 import cv2
 try:
     import gdal
@@ -13,20 +15,117 @@ except ImportError:
     from osgeo import gdal
 import numpy as np
 from os.path import basename
+from .fixed_thread_pool_executor import FixedThreadPoolExecutor
+try:
+    from .guided_filter_numba import guidedfilter_numba
+except ImportError:
+    guidedfilter_numba = None
+
+# The edge length in pixels of tiles to filter at a time
+TILE_SIZE = 1024
+# The edge length in pixels of blocks of GTiff outputs,
+# TILE_SIZE is a multiple of it so tiles cover whole blocks
+GTIFF_BLOCK_SIZE = 512
+# The largest kernel size to take window means from cv2.boxFilter directly,
+# larger kernels use integral images whose cost does not depend on ksize
+BOX_FILTER_KSIZE = 7
+
+
+def _pad(src, ksize):
+    """Pad the input image with the same reflected border as `cv2.boxFilter`,
+    so every window of its integral image stays inside the image.
+
+    Args:
+        src (numpy.ndarray): input image in numpy.ndarray format.
+        ksize (int): kernel size.
+
+    Returns:
+        numpy.ndarray: the padded image.
+    """
+    top = ksize // 2
+    bottom = ksize - 1 - top
+    return cv2.copyMakeBorder(src, top, bottom, top, bottom, cv2.BORDER_REFLECT_101)
+
+
+def _integral(src, ksize):
+    """Compute the integral image of the input image padded for box means.
+
+    Args:
+        src (numpy.ndarray): input image in numpy.ndarray format.
+        ksize (int): kernel size.
+
+    Returns:
+        numpy.ndarray of numpy.float64: the integral image.
+    """
+    return cv2.integral(_pad(src, ksize), sdepth=cv2.CV_64F)
+
+
+def _integral2(src, ksize):
+    """Compute the integral images of the input image and its square
+    in a single pass, padded for box means.
+
+    Args:
+        src (numpy.ndarray): input image in numpy.ndarray format.
+        ksize (int): kernel size.
+
+    Returns:
+        tuple of numpy.ndarray of numpy.float64: the integral images of
+        the image and the squared image.
+    """
+    return cv2.integral2(_pad(src, ksize), sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
 
 
-def _boxfilter(src, ksize):
-    """Apply box filter on the input image in numpy.ndarray format.
+def _box_mean(integ, ksize, dtype=np.float64):
+    """Get the mean of each ksize x ksize window from an integral image.
+
+    Args:
+        integ (numpy.ndarray): the integral image from `_integral`.
+        ksize (int): kernel size.
+        dtype (numpy.dtype): the data type of the means.
+
+    Returns:
+        numpy.ndarray: the window means.
+    """
+    window_sum = integ[ksize:, ksize:] - integ[:-ksize, ksize:]
+    window_sum -= integ[ksize:, :-ksize]
+    window_sum += integ[:-ksize, :-ksize]
+    window_sum *= 1.0 / (ksize * ksize)
+    return window_sum.astype(dtype, copy=False)
+
+
+def _window_mean(src, ksize, dtype=np.float64):
+    """Get the mean of each ksize x ksize window of the input image.
+
+    Args:
+        src (numpy.ndarray): input image in numpy.ndarray format.
+        ksize (int): kernel size.
+        dtype (numpy.dtype): the data type of the means.
+
+    Returns:
+        numpy.ndarray: the window means.
+    """
+    if ksize <= BOX_FILTER_KSIZE:
+        return cv2.boxFilter(src, cv2.CV_64F, (ksize, ksize)).astype(dtype, copy=False)
+    return _box_mean(_integral(src, ksize), ksize, dtype)
+
+
+def _window_means2(src, ksize):
+    """Get the means of each ksize x ksize window of the input image and its square.
 
     Args:
         src (numpy.ndarray): input image in numpy.ndarray format.
         ksize (int): kernel size.
 
     Returns:
-        numpy.ndarray: the processed image in numpy.ndarray format.
+        tuple of numpy.ndarray of numpy.float64: the window means of
+        the image and the squared image.
     """
-    bf = cv2.boxFilter(src, -1, (ksize, ksize))
-    return bf
+    if ksize <= BOX_FILTER_KSIZE:
+        return (cv2.boxFilter(src, cv2.CV_64F, (ksize, ksize)),
+                cv2.sqrBoxFilter(src, cv2.CV_64F, (ksize, ksize)))
+    # The squared image is summed along with the image itself
+    integ, integ_sq = _integral2(src, ksize)
+    return _box_mean(integ, ksize), _box_mean(integ_sq, ksize)
 
 
 def _guidedfilter(fsrc, src, ksize, eps):
@@ -41,32 +140,190 @@ def _guidedfilter(fsrc, src, ksize, eps):
     Returns:
         numpy.ndarray of numpy.float32: the processed image in numpy.ndarray format.
     """
-    mean_guided = _boxfilter(fsrc, ksize)
-    mean_img = _boxfilter(src, ksize)
-    mean_gi = _boxfilter(fsrc * src, ksize)
-    mean_gg = _boxfilter(fsrc * fsrc, ksize)
+    # Window sums of large kernels come from integral images by
+    # 4-corner lookups, so the cost no longer depends on ksize
+    mean_guided, mean_gg = _window_means2(fsrc, ksize)
+    mean_img = _window_mean(src, ksize)
+    # One scratch buffer is reused for every product below,
+    # and results overwrite the means once they are no longer needed.
+    # Keep float64 until a and b are both computed: nodata is filled with -9999,
+    # and the variance of such windows loses all precision in float32.
+    # Everything after that is float32.
+    buf = np.multiply(fsrc, src, dtype=np.float64)
+    mean_gi = _window_mean(buf, ksize)
 
     # covariance of (I,P) in each local patch
-    cov_gi = mean_gi - mean_guided * mean_img
-    var_g = mean_gg - mean_guided * mean_guided
+    np.multiply(mean_guided, mean_img, out=buf)
+    cov_gi = np.subtract(mean_gi, buf, out=mean_gi)
+    np.multiply(mean_guided, mean_guided, out=buf)
+    var_g = np.subtract(mean_gg, buf, out=mean_gg)
 
     # equation 5 in the paper
     # Add a 0.0001 in case zero happens
-    a = cov_gi / (var_g + np.float32(eps + 0.0001))
+    var_g += eps + 0.0001
+    a = np.divide(cov_gi, var_g, out=cov_gi)
     # equation 6 in the paper
-    b = mean_img - a * mean_guided
+    np.multiply(a, mean_guided, out=buf)
+    b = np.subtract(mean_img, buf, dtype=np.float32)
+    a = a.astype(np.float32)
 
-    mean_a = _boxfilter(a, ksize)
-    mean_b = _boxfilter(b, ksize)
+    mean_a = _window_mean(a, ksize, np.float32)
+    mean_b = _window_mean(b, ksize, np.float32)
 
     # equation 8 in the paper
-    q = mean_a * fsrc + mean_b
+    q = np.multiply(mean_a, fsrc, out=mean_a)
+    q += mean_b
     return q
 
 
-def guided_filter(src_path, ksize, eps, dst_dir, out_format='ENVI'):
+def _self_guided_filter(src, ksize, eps):
+    """Apply guided filter on the input image guided by itself.
+    With the image as its own guide, the covariance of (I,P) is the variance of I,
+    so a = var / (var + eps) and b = mean * (1 - a).
+
+    Args:
+        src (numpy.ndarray of numpy.float32): image in numpy.ndarray format to be filtered.
+        ksize (int): kernel size.
+        eps (int): regularization parameter.
+
+    Returns:
+        numpy.ndarray of numpy.float32: the processed image in numpy.ndarray format.
+    """
+    mean, mean_sq = _window_means2(src, ksize)
+
+    # variance of I in each local patch, in float64 as in `_guidedfilter`
+    buf = np.multiply(mean, mean)
+    var = np.subtract(mean_sq, buf, out=mean_sq)
+
+    # equation 5 in the paper
+    # Add a 0.0001 in case zero happens
+    np.add(var, eps + 0.0001, out=buf)
+    a = np.divide(var, buf, out=var)
+    # equation 6 in the paper
+    np.subtract(1.0, a, out=buf)
+    b = np.multiply(buf, mean, dtype=np.float32)
+    a = a.astype(np.float32)
+
+    mean_a = _window_mean(a, ksize, np.float32)
+    mean_b = _window_mean(b, ksize, np.float32)
+
+    # equation 8 in the paper
+    q = np.multiply(mean_a, src, out=mean_a)
+    q += mean_b
+    return q
+
+
+def _apply_guidedfilter(fsrc, src, ksize, eps):
+    """Apply guided filter with the fastest implementation available.
+    Use `cv2.ximgproc.guidedFilter` if opencv-contrib is installed,
+    then the numba kernels if numba is installed,
+    otherwise the numpy implementation `_guidedfilter`,
+    or `_self_guided_filter` if the image is its own guide.
+    cv2.ximgproc only supports odd window sizes, i.e. a radius.
+
+    Args:
+        fsrc (numpy.ndarray of numpy.float32): guide image in numpy.ndarray format.
+        src (numpy.ndarray of numpy.float32): image in numpy.ndarray format to be filtered.
+        ksize (int): kernel size.
+        eps (int): regularization parameter.
+
+    Returns:
+        numpy.ndarray of numpy.float32: the processed image in numpy.ndarray format.
+    """
+    if hasattr(cv2, 'ximgproc') and ksize % 2 == 1:
+        # Add a 0.0001 in case zero happens
+        return cv2.ximgproc.guidedFilter(guide=np.float32(fsrc), src=np.float32(src),
+                                         radius=ksize // 2, eps=float(eps) + 0.0001)
+    if guidedfilter_numba is not None:
+        return guidedfilter_numba(fsrc, src, ksize, eps)
+    if fsrc is src:
+        return _self_guided_filter(src, ksize, eps)
+    return _guidedfilter(fsrc, src, ksize, eps)
+
+
+def _tile_windows(width, height, block_size):
+    """Split an imagery into windows aligned with the blocks of GDAL.
+
+    Args:
+        width (int): the width of the imagery.
+        height (int): the height of the imagery.
+        block_size (list of int): the natural block size [x, y] of the band.
+
+    Returns:
+        list of tuple: windows of (xoff, yoff, xsize, ysize).
+    """
+    tile_x = max(block_size[0], TILE_SIZE // block_size[0] * block_size[0])
+    tile_y = max(block_size[1], TILE_SIZE // block_size[1] * block_size[1])
+    return [(xoff, yoff, min(tile_x, width - xoff), min(tile_y, height - yoff))
+            for yoff in range(0, height, tile_y)
+            for xoff in range(0, width, tile_x)]
+
+
+def _filter_tile(src_path, band_index, window, ksize, eps):
+    """Apply guided filter to a window of a band.
+    The window is read with a halo of ksize pixels,
+    so the result is the same as filtering the whole band.
+    The imagery is opened by each call because GDAL datasets
+    cannot be shared between threads.
+
+    Args:
+        src_path (str): the source path of the imagery.
+        band_index (int): the index of the band, starting from 1.
+        window (tuple): the window of (xoff, yoff, xsize, ysize).
+        ksize (int): kernel size.
+        eps (int): regularization parameter.
+
+    Returns:
+        numpy.ndarray of numpy.float32: the processed window.
+    """
+    img = gdal.Open(src_path)
+    inband = img.GetRasterBand(band_index)
+    nodata = inband.GetNoDataValue()
+    novalue = np.float32(nodata)
+    xoff, yoff, xsize, ysize = window
+    x_start = max(xoff - ksize, 0)
+    y_start = max(yoff - ksize, 0)
+    x_end = min(xoff + xsize + ksize, img.RasterXSize)
+    y_end = min(yoff + ysize + ksize, img.RasterYSize)
+    # Let GDAL fill a float32 buffer directly instead of casting a copy
+    band_raw = inband.ReadAsArray(x_start, y_start,
+                                  x_end - x_start, y_end - y_start,
+                                  buf_type=gdal.GDT_Float32)
+    if nodata is not None:
+        # Remove inf
+        band_raw[np.isinf(band_raw)] = novalue
+        # Mask no data once, for both filling and restoring
+        mask = np.isnan(band_raw) if np.isnan(nodata) else band_raw == novalue
+        band = np.where(mask, np.float32(-9999), band_raw)
+        out = _apply_guidedfilter(band, band, ksize, eps)
+        np.copyto(out, band_raw, where=mask)
+    else:
+        out = _apply_guidedfilter(band_raw, band_raw, ksize, eps)
+    img = None
+
+    # Crop the halo
+    return out[yoff - y_start:yoff - y_start + ysize,
+               xoff - x_start:xoff - x_start + xsize]
+
+
+def _gtiff_compress(driver):
+    """Choose the compression of GTiff outputs.
+
+    Args:
+        driver (gdal.Driver): the GTiff driver.
+
+    Returns:
+        str: ZSTD if GDAL is built with it, otherwise DEFLATE.
+    """
+    creation_options = driver.GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    return 'ZSTD' if 'ZSTD' in creation_options else 'DEFLATE'
+
+
+def guided_filter(src_path, ksize, eps, dst_dir, out_format='ENVI', threads_number=None):
     """Apply guided filter to a single imagery.
     The result will be saved with ENVI format.
+    The imagery is processed in tiles, so the memory use
+    does not grow with the size of the imagery.
 
     Args:
         src_path (str): the source path of the imagery.
@@ -74,11 +331,15 @@ def guided_filter(src_path, ksize, eps, dst_dir, out_format='ENVI'):
         eps (int): regularization parameter.
         dst_dir (str): the destination path of the processed imagery.
         out_format (str); the format of output. Now it only supports [ENVI, GTiff].
+        threads_number (int): the number of threads to filter tiles.
+        Use all CPUs if None.
     """
     img = gdal.Open(src_path)
     width = img.RasterXSize
     height = img.RasterYSize
     n_band = img.RasterCount
+    if threads_number is None:
+        threads_number = mp.cpu_count()
     if out_format == 'ENVI':
         driver = gdal.GetDriverByName(out_format)
         dst_path = os.path.join(dst_dir, "{}".format(basename(src_path)))
@@ -87,41 +348,46 @@ def guided_filter(src_path, ksize, eps, dst_dir, out_format='ENVI'):
     elif out_format == 'GTiff':
         driver = gdal.GetDriverByName(out_format)
         dst_path = os.path.join(dst_dir, "{}".format(basename(src_path).replace('img', 'tif')))
-        out_data = driver.Create(dst_path, width, height, n_band, gdal.GDT_Float32)
+        # Tiled and compressed, PREDICTOR=3 is the floating point predictor
+        options = ["TILED=YES",
+                   "BLOCKXSIZE={}".format(GTIFF_BLOCK_SIZE),
+                   "BLOCKYSIZE={}".format(GTIFF_BLOCK_SIZE),
+                   "COMPRESS={}".format(_gtiff_compress(driver)),
+                   "PREDICTOR=3",
+                   "NUM_THREADS={}".format(threads_number)]
+        out_data = driver.Create(dst_path, width, height, n_band, gdal.GDT_Float32,
+                                 options=options)
     else:
         sys.exit('Not support out format. Must be [ENVI, GTiff].')
-    for i in range(n_band):
-        novalue = np.float32(img.GetRasterBand(i + 1).GetNoDataValue())
-        band_raw = np.float32(img.GetRasterBand(i + 1).ReadAsArray())
-        # Remove inf
-        band_raw = np.where(np.isinf(band_raw),
-                            img.GetRasterBand(i + 1).GetNoDataValue(),
-                            band_raw)
-        if img.GetRasterBand(i + 1).GetNoDataValue() is not None:
-            if np.isnan(img.GetRasterBand(i + 1).GetNoDataValue()):
-                band = np.where(np.isnan(band_raw), -9999, band_raw)
-                band_filter = _guidedfilter(band, band, ksize, eps)
-                out = np.where(np.isnan(band_raw), band_raw, band_filter)
-            else:
-                band = np.where(band_raw == novalue, -9999, band_raw)
-                band_filter = _guidedfilter(band, band, ksize, eps)
-                out = np.where(band_raw == novalue, band_raw, band_filter)
-            outband = out_data.GetRasterBand(i + 1)
-            # If need to set No Data Value
-            outband.SetNoDataValue(img.GetRasterBand(i + 1).GetNoDataValue())
-        else:
-            band = np.float32(img.GetRasterBand(i + 1).ReadAsArray())
-            out = _guidedfilter(band, band, ksize, eps)
-            outband = out_data.GetRasterBand(i + 1)
-        outband.WriteArray(out)
-        out_data.FlushCache()
     out_data.SetGeoTransform(img.GetGeoTransform())
-    out_data.FlushCache()
     out_data.SetProjection(img.GetProjection())
+
+    # The output dataset is not thread-safe, so tiles are written one by one
+    write_lock = Lock()
+
+    def _process_tile(band_index, window):
+        out = _filter_tile(src_path, band_index, window, ksize, eps)
+        with write_lock:
+            out_data.GetRasterBand(band_index).WriteArray(out, window[0], window[1])
+
+    # Gather the tiles of all bands, so bands are filtered concurrently
+    tasks = []
+    for i in range(n_band):
+        inband = img.GetRasterBand(i + 1)
+        nodata = inband.GetNoDataValue()
+        if nodata is not None:
+            # If need to set No Data Value
+            out_data.GetRasterBand(i + 1).SetNoDataValue(nodata)
+        tasks.extend((i + 1, window) for window in
+                     _tile_windows(width, height, inband.GetBlockSize()))
+    gf_executor = FixedThreadPoolExecutor(size=min(len(tasks), threads_number))
+    for band_index, window in tasks:
+        gf_executor.submit(_process_tile, band_index, window)
+    gf_executor.drain()
+    gf_executor.close()
+    gf_executor.raise_first()
+    # Write all dirty blocks to disk once
     out_data.FlushCache()
     # Close opens
     out_data = None
     img = None
-    band_raw = None
-
-    del img, band_raw, band, out_data, novalue, outband, band_filter
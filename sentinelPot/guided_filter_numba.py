@@ -0,0 +1,217 @@
+"""
+This is a chunk of numba kernels to do guided filter for an image.
+It does the same calculation as `_guidedfilter` in guided_filter.py,
+but in row tiles with running window sums, so each image is streamed
+through memory only a few times. The kernels are serial and release the GIL,
+the tiles and images are filtered in threads by the callers, so the kernels
+do not depend on the threading layer of numba.
+It is optional and only used when numba is installed.
+Author: Lei Song
+Maintainer: Lei Song (lsong@clarku.edu)
+"""
+import numpy as np
+from numba import njit
+
+# Number of rows processed at a time in the vertical passes
+TILE_ROWS = 128
+
+
+@njit(cache=True)
+def _reflect(i, n):
+    """Map an index into [0, n) with the BORDER_REFLECT_101 rule of cv2.boxFilter.
+
+    Args:
+        i (int): the index to map.
+        n (int): the length of the axis.
+
+    Returns:
+        int: the mapped index.
+    """
+    if n == 1:
+        return 0
+    while i < 0 or i >= n:
+        if i < 0:
+            i = -i
+        else:
+            i = 2 * n - 2 - i
+    return i
+
+
+@njit(nogil=True, cache=True)
+def _row_sums_guided(fsrc, src, ksize, sums):
+    """Horizontal window sums of guide, image, guide*image and guide*guide.
+
+    Args:
+        fsrc (numpy.ndarray of numpy.float32): guide image.
+        src (numpy.ndarray of numpy.float32): image to be filtered.
+        ksize (int): kernel size.
+        sums (numpy.ndarray of numpy.float64): output with shape (4, height, width).
+    """
+    height, width = fsrc.shape
+    top = ksize // 2
+    bottom = ksize - 1 - top
+    for y in range(height):
+        sum_g = 0.0
+        sum_s = 0.0
+        sum_gs = 0.0
+        sum_gg = 0.0
+        for x in range(-top, bottom + 1):
+            xx = _reflect(x, width)
+            g = np.float64(fsrc[y, xx])
+            s = np.float64(src[y, xx])
+            sum_g += g
+            sum_s += s
+            sum_gs += g * s
+            sum_gg += g * g
+        for x in range(width):
+            if x > 0:
+                x_in = _reflect(x + bottom, width)
+                x_out = _reflect(x - 1 - top, width)
+                g_in = np.float64(fsrc[y, x_in])
+                s_in = np.float64(src[y, x_in])
+                g_out = np.float64(fsrc[y, x_out])
+                s_out = np.float64(src[y, x_out])
+                sum_g += g_in - g_out
+                sum_s += s_in - s_out
+                sum_gs += g_in * s_in - g_out * s_out
+                sum_gg += g_in * g_in - g_out * g_out
+            sums[0, y, x] = sum_g
+            sums[1, y, x] = sum_s
+            sums[2, y, x] = sum_gs
+            sums[3, y, x] = sum_gg
+
+
+@njit(nogil=True, cache=True)
+def _row_sums_coefs(coefs, ksize, sums):
+    """Horizontal window sums of the linear coefficients a and b.
+
+    Args:
+        coefs (numpy.ndarray of numpy.float32): a and b with shape (2, height, width).
+        ksize (int): kernel size.
+        sums (numpy.ndarray of numpy.float64): output with shape (2, height, width).
+    """
+    _, height, width = coefs.shape
+    top = ksize // 2
+    bottom = ksize - 1 - top
+    for y in range(height):
+        sum_a = 0.0
+        sum_b = 0.0
+        for x in range(-top, bottom + 1):
+            xx = _reflect(x, width)
+            sum_a += coefs[0, y, xx]
+            sum_b += coefs[1, y, xx]
+        for x in range(width):
+            if x > 0:
+                x_in = _reflect(x + bottom, width)
+                x_out = _reflect(x - 1 - top, width)
+                sum_a += np.float64(coefs[0, y, x_in]) - coefs[0, y, x_out]
+                sum_b += np.float64(coefs[1, y, x_in]) - coefs[1, y, x_out]
+            sums[0, y, x] = sum_a
+            sums[1, y, x] = sum_b
+
+
+@njit(nogil=True, cache=True)
+def _coefficients(sums, ksize, eps, coefs):
+    """Vertical window sums of the row sums, fused with equation 5 and 6.
+
+    Args:
+        sums (numpy.ndarray of numpy.float64): row sums from `_row_sums_guided`.
+        ksize (int): kernel size.
+        eps (float): regularization parameter.
+        coefs (numpy.ndarray of numpy.float32): output a and b with shape (2, height, width).
+    """
+    _, height, width = sums.shape
+    top = ksize // 2
+    bottom = ksize - 1 - top
+    norm = 1.0 / (ksize * ksize)
+    n_tiles = (height + TILE_ROWS - 1) // TILE_ROWS
+    for t in range(n_tiles):
+        y_start = t * TILE_ROWS
+        y_end = min(y_start + TILE_ROWS, height)
+        cols = np.zeros((4, width))
+        for y in range(y_start - top, y_start + bottom + 1):
+            yy = _reflect(y, height)
+            for x in range(width):
+                for k in range(4):
+                    cols[k, x] += sums[k, yy, x]
+        for y in range(y_start, y_end):
+            if y > y_start:
+                y_in = _reflect(y + bottom, height)
+                y_out = _reflect(y - 1 - top, height)
+                for x in range(width):
+                    for k in range(4):
+                        cols[k, x] += sums[k, y_in, x] - sums[k, y_out, x]
+            for x in range(width):
+                mean_guided = cols[0, x] * norm
+                mean_img = cols[1, x] * norm
+                # covariance of (I,P) in each local patch
+                cov_gi = cols[2, x] * norm - mean_guided * mean_img
+                var_g = cols[3, x] * norm - mean_guided * mean_guided
+                # equation 5 and 6 in the paper
+                a = cov_gi / (var_g + eps)
+                coefs[0, y, x] = a
+                coefs[1, y, x] = mean_img - a * mean_guided
+
+
+@njit(nogil=True, cache=True)
+def _output(fsrc, sums, ksize, out):
+    """Vertical window sums of the coefficients, fused with equation 8.
+
+    Args:
+        fsrc (numpy.ndarray of numpy.float32): guide image.
+        sums (numpy.ndarray of numpy.float64): row sums from `_row_sums_coefs`.
+        ksize (int): kernel size.
+        out (numpy.ndarray of numpy.float32): the filtered image.
+    """
+    height, width = fsrc.shape
+    top = ksize // 2
+    bottom = ksize - 1 - top
+    norm = 1.0 / (ksize * ksize)
+    n_tiles = (height + TILE_ROWS - 1) // TILE_ROWS
+    for t in range(n_tiles):
+        y_start = t * TILE_ROWS
+        y_end = min(y_start + TILE_ROWS, height)
+        cols = np.zeros((2, width))
+        for y in range(y_start - top, y_start + bottom + 1):
+            yy = _reflect(y, height)
+            for x in range(width):
+                cols[0, x] += sums[0, yy, x]
+                cols[1, x] += sums[1, yy, x]
+        for y in range(y_start, y_end):
+            if y > y_start:
+                y_in = _reflect(y + bottom, height)
+                y_out = _reflect(y - 1 - top, height)
+                for x in range(width):
+                    cols[0, x] += sums[0, y_in, x] - sums[0, y_out, x]
+                    cols[1, x] += sums[1, y_in, x] - sums[1, y_out, x]
+            for x in range(width):
+                # equation 8 in the paper
+                out[y, x] = cols[0, x] * norm * fsrc[y, x] + cols[1, x] * norm
+
+
+def guidedfilter_numba(fsrc, src, ksize, eps):
+    """Apply guided filter on the input image with numba kernels.
+
+    Args:
+        fsrc (numpy.ndarray of numpy.float32): guide image in numpy.ndarray format.
+        src (numpy.ndarray of numpy.float32): image in numpy.ndarray format to be filtered.
+        ksize (int): kernel size.
+        eps (int): regularization parameter.
+
+    Returns:
+        numpy.ndarray of numpy.float32: the processed image in numpy.ndarray format.
+    """
+    fsrc = np.ascontiguousarray(fsrc, dtype=np.float32)
+    src = np.ascontiguousarray(src, dtype=np.float32)
+    height, width = fsrc.shape
+    # Keep the sums in float64: nodata is filled with -9999, and the
+    # variance of such windows loses all precision in float32
+    sums = np.empty((4, height, width))
+    _row_sums_guided(fsrc, src, ksize, sums)
+    # Add a 0.0001 in case zero happens
+    coefs = np.empty((2, height, width), dtype=np.float32)
+    _coefficients(sums, ksize, float(eps) + 0.0001, coefs)
+    _row_sums_coefs(coefs, ksize, sums[:2])
+    out = np.empty((height, width), dtype=np.float32)
+    _output(fsrc, sums[:2], ksize, out)
+    return out
@@ -0,0 +1,220 @@
+"""
+This is a chunk of numba kernels to fit lasso of harmonic regression.
+It does the same calculation as `_fit_harmonic` in preprocess_level3.py,
+but fits pixel by pixel in compiled loops over all cores,
+so pixels with their own valid dates cost no python overhead.
+It also has a kernel to replace nodata of images as they are read.
+It is optional and only used when numba is installed.
+Author: Lei Song
+Maintainer: Lei Song (lsong@clarku.edu)
+"""
+import numpy as np
+from numba import njit, prange
+
+# Number of pixels fitted by each parallel task
+CHUNK_PIXELS = 1024
+# Fast math flags without nnan and ninf, the nodata is nan
+FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+
+@njit(fastmath=FASTMATH, cache=True)
+def _lasso_pixel(gram, q, y_norm2, alpha, max_iter, tol, w, h):
+    """Fit lasso for one pixel by coordinate descent with its Gram matrix,
+    which stops as sklearn.linear_model.Lasso does.
+    Each update costs O(p) instead of O(T) with the Gram matrix.
+    It starts from the coefficients in w, e.g. those of the previous pixel.
+
+    Args:
+        gram (numpy.ndarray of numpy.float64): the Gram matrix of centered variables with shape (p, p).
+        q (numpy.ndarray of numpy.float64): the product of centered variables and targets with shape (p,).
+        y_norm2 (float): the squared norm of centered targets.
+        alpha (float): the alpha of lasso, multiplied by the number of samples.
+        max_iter (int): the most sweeps.
+        tol (float): the tolerance of duality gap.
+        w (numpy.ndarray of numpy.float64): initial and output coefficients with shape (p,).
+        h (numpy.ndarray of numpy.float64): buffer of the product of gram and w with shape (p,).
+    """
+    p = gram.shape[0]
+    d_w_tol = tol
+    tol = tol * y_norm2
+    # Variables which are constant over the valid dates are never updated
+    for j in range(p):
+        if gram[j, j] == 0.0:
+            w[j] = 0.0
+    for j in range(p):
+        s = 0.0
+        for k in range(p):
+            s += gram[j, k] * w[k]
+        h[j] = s
+
+    for _ in range(max_iter):
+        w_max = 0.0
+        d_w_max = 0.0
+        for j in range(p):
+            if gram[j, j] == 0.0:
+                continue
+            w_j = w[j]
+            rho = q[j] - h[j] + gram[j, j] * w_j
+            if rho > alpha:
+                w[j] = (rho - alpha) / gram[j, j]
+            elif rho < -alpha:
+                w[j] = (rho + alpha) / gram[j, j]
+            else:
+                w[j] = 0.0
+            d_w = w[j] - w_j
+            if d_w != 0.0:
+                for k in range(p):
+                    h[k] += d_w * gram[k, j]
+            d_w_max = max(d_w_max, abs(d_w))
+            w_max = max(w_max, abs(w[j]))
+
+        if w_max == 0.0 or d_w_max <= d_w_tol * w_max:
+            # Duality gap
+            dual_norm = 0.0
+            q_dot_w = 0.0
+            w_dot_h = 0.0
+            l1_norm = 0.0
+            for j in range(p):
+                dual_norm = max(dual_norm, abs(q[j] - h[j]))
+                q_dot_w += q[j] * w[j]
+                w_dot_h += w[j] * h[j]
+                l1_norm += abs(w[j])
+            r_norm2 = y_norm2 + w_dot_h - 2 * q_dot_w
+            if dual_norm > alpha:
+                const = alpha / dual_norm
+                gap = 0.5 * r_norm2 * (1 + const * const)
+            else:
+                const = 1.0
+                gap = r_norm2
+            gap += alpha * l1_norm - const * y_norm2 + const * q_dot_w
+            if gap <= tol:
+                break
+
+
+@njit(parallel=True, fastmath=FASTMATH, cache=True)
+def _lasso_pixels(values, x, alpha, max_iter, tol, out):
+    """Fit lasso of harmonic regression for all pixels.
+
+    Args:
+        values (numpy.ndarray): the values of pixels with shape (T, N), nan for nodata.
+        x (numpy.ndarray of numpy.float64): x variable for harmonic regression with shape (T, p).
+        alpha (float): the alpha of lasso.
+        max_iter (int): the most sweeps of each pixel.
+        tol (float): the tolerance of duality gap.
+        out (numpy.ndarray of numpy.float32): the intercept and coefficients with shape (p + 1, N).
+    """
+    n_dates, n_pixels = values.shape
+    p = x.shape[1]
+    n_chunks = (n_pixels + CHUNK_PIXELS - 1) // CHUNK_PIXELS
+    for chunk in prange(n_chunks):
+        xc = np.empty((n_dates, p))
+        y = np.empty(n_dates)
+        gram = np.empty((p, p))
+        q = np.empty(p)
+        # Neighbouring pixels have similar coefficients,
+        # so each pixel starts from the previous one of the chunk
+        w = np.zeros(p)
+        h = np.empty(p)
+        x_mean = np.empty(p)
+        for i in range(chunk * CHUNK_PIXELS, min((chunk + 1) * CHUNK_PIXELS, n_pixels)):
+            # Gather the valid dates
+            n = 0
+            for t in range(n_dates):
+                v = values[t, i]
+                if not np.isnan(v):
+                    y[n] = v
+                    for j in range(p):
+                        xc[n, j] = x[t, j]
+                    n += 1
+            if n == 0:
+                for j in range(p + 1):
+                    out[j, i] = np.nan
+                continue
+
+            # Center variables and targets for the intercept
+            y_mean = 0.0
+            for t in range(n):
+                y_mean += y[t]
+            y_mean /= n
+            for t in range(n):
+                y[t] -= y_mean
+            for j in range(p):
+                s = 0.0
+                for t in range(n):
+                    s += xc[t, j]
+                x_mean[j] = s / n
+                for t in range(n):
+                    xc[t, j] -= x_mean[j]
+
+            # The Gram matrix and products, once for all sweeps
+            y_norm2 = 0.0
+            for t in range(n):
+                y_norm2 += y[t] * y[t]
+            for j in range(p):
+                s = 0.0
+                for t in range(n):
+                    s += xc[t, j] * y[t]
+                q[j] = s
+                for k in range(j + 1):
+                    s = 0.0
+                    for t in range(n):
+                        s += xc[t, j] * xc[t, k]
+                    gram[j, k] = s
+                    gram[k, j] = s
+
+            _lasso_pixel(gram, q, y_norm2, alpha * n, max_iter, tol, w, h)
+            intercept = y_mean
+            for j in range(p):
+                intercept -= x_mean[j] * w[j]
+                out[j + 1, i] = w[j]
+            out[0, i] = intercept
+
+
+@njit(cache=True)
+def _replace_nodata(values, novalue):
+    """Replace nodata of an image with nan in place, in one pass.
+    It is serial, images are read in threads and each runs it on its own.
+
+    Args:
+        values (numpy.ndarray of numpy.float32): the image with shape (rows, cols).
+        novalue (numpy.float32): the nodata value.
+    """
+    rows, cols = values.shape
+    for i in range(rows):
+        for j in range(cols):
+            if values[i, j] == novalue:
+                values[i, j] = np.nan
+
+
+def replace_nodata_numba(values, novalue):
+    """Replace nodata of an image with nan in place with numba kernels.
+
+    Args:
+        values (numpy.ndarray of numpy.float32): the image with shape (rows, cols).
+        novalue (float): the nodata value.
+
+    Returns:
+        numpy.ndarray of numpy.float32: values.
+    """
+    _replace_nodata(values, np.float32(novalue))
+    return values
+
+
+def fit_harmonic_numba(values, x, alpha, max_iter, tol):
+    """Fit lasso of harmonic regression for all pixels with numba kernels.
+
+    Args:
+        values (numpy.ndarray): the values of pixels with shape (T, N), nan for nodata.
+        x (numpy.ndarray): x variable for harmonic regression with shape (T, p).
+        alpha (float): the alpha of lasso.
+        max_iter (int): the most sweeps of coordinate descent of each pixel.
+        tol (float): the tolerance of duality gap to stop.
+
+    Returns:
+        numpy.ndarray of numpy.float32: the intercept and coefficients with shape (p + 1, N).
+    """
+    # The variables stay float64, each pixel is fitted in float64 anyway
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    out = np.empty((x.shape[1] + 1, values.shape[1]), dtype=np.float32)
+    _lasso_pixels(values, x, float(alpha), max_iter, tol, out)
+    return out
@@ -4,15 +4,119 @@ Author: Lei Song
 Maintainer: Lei Song (lsong@clarku.edu)
 """
 import os
+import copy
+import json
+import pickle
+import hashlib
+import queue
+import shlex
 import yaml
+import atexit
 import shutil
+import signal
+import logging
+import threading
+import requests
+import numpy as np
+import multiprocessing as mp
 from os.path import join
 from zipfile import ZipFile
 import subprocess
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from .fixed_thread_pool_executor import FixedThreadPoolExecutor
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Characters which must be expanded by a shell, e.g. globs and variables
+SHELL_CHARS = set('*?$`~')
+# The format of log records
+LOG_FORMAT = "%(asctime)s::%(levelname)s::%(name)s::%(filename)s::%(lineno)d::%(message)s"
+# The log file the root logger currently writes to
+_log_file = None
+# The thread which writes the queued log records to the log file
+_log_listener = None
+# The running child processes of _run_cmd
+_children = set()
+_children_lock = threading.Lock()
+# The number of ranges of a file downloaded at the same time
+DOWNLOAD_PARTS = 8
+# The least size in bytes of a file to download in ranges
+DOWNLOAD_PART_MIN_SIZE = 8 * 1024 * 1024
+# The size in bytes of chunks written to a downloading file
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _stop_logging():
+    """Write out the queued log records and close the log file."""
+    global _log_file, _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+        _log_file = None
+
+
+atexit.register(_stop_logging)
+
+
+def _setup_logging(log_path, name, mode='w'):
+    """Set the root logger to write to a log file through a queue.
+    Worker threads only put records into the queue,
+    and one listener thread writes them to the file.
+    It is only set up again when the log file changes.
+
+    Args:
+        log_path (str): the path of log file.
+        name (str): the name of the logger to return.
+        mode (str): the mode to open the log file,
+        'a' for worker processes to append to the log of the parent.
+
+    Returns:
+        logging.Logger: the logger with the name.
+    """
+    global _log_file, _log_listener
+    if log_path != _log_file:
+        _stop_logging()
+        for handler in logging.root.handlers[:]:
+            logging.root.removeHandler(handler)
+        file_handler = logging.FileHandler(log_path, mode=mode)
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        log_queue = queue.Queue(-1)
+        logging.root.addHandler(QueueHandler(log_queue))
+        logging.root.setLevel(logging.INFO)
+        _log_listener = QueueListener(log_queue, file_handler)
+        _log_listener.start()
+        _log_file = log_path
+    return logging.getLogger(name)
+
+
+@lru_cache(maxsize=100)
+def _parse_yaml(config_path, mtime, size):
+    """Parse a yaml file, cached by its path, modification time and size
+
+    Args:
+        config_path (str): the path of config yaml.
+        mtime (int): the modification time of the file in nanoseconds.
+        size (int): the size of the file in bytes.
+
+    Returns:
+        dict: config, a dictionary of configs.
+    """
+    with open(config_path, 'r') as yaml_file:
+        return yaml.load(yaml_file, Loader=SafeLoader)
 
 
 def _load_yaml(config_path, logger=None):
     """Load config yaml file
+    The file is parsed again only if it has been modified.
 
     Args:
         config_path (str): the path of config yaml.
@@ -22,46 +126,214 @@ def _load_yaml(config_path, logger=None):
         dict: config, a dictionary of configs.
     """
     try:
-        with open(config_path, 'r') as yaml_file:
-            config = yaml.safe_load(yaml_file)
-            return config
+        stat = os.stat(config_path)
+        config = _parse_yaml(config_path, stat.st_mtime_ns, stat.st_size)
     except OSError:
         if logger is None:
             print("Cannot open", config_path)
         else:
-            logger.error("Cannot open", config_path)
+            logger.error("Cannot open {}".format(config_path))
         raise
+    # Copy the cached config, so callers cannot change it
+    return copy.deepcopy(config)
+
+
+def _json_loads(content):
+    """Parse JSON, with orjson if it is installed.
+
+    Args:
+        content (bytes or str): the JSON document.
+
+    Returns:
+        the parsed object.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _json_dumps(obj):
+    """Serialize an object to JSON, with orjson if it is installed.
+
+    Args:
+        obj: the object to serialize.
+
+    Returns:
+        bytes: the JSON document.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
 
+@lru_cache(maxsize=16)
+def _parse_footprint(path, mtime, size, cache_dir=None):
+    """Parse a footprint geojson, cached by its path, modification time and size.
+    With cache_dir, it is also pickled there and named by the hash of the full path,
+    so later runs load the pickle instead while it is newer than the geojson.
+
+    Args:
+        path (str): the path of footprint geojson.
+        mtime (int): the modification time of the file in nanoseconds.
+        size (int): the size of the file in bytes.
+        cache_dir (str): the directory to pickle the geojson, optional.
+
+    Returns:
+        dict: the footprint geojson.
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = join(cache_dir, '{}.pkl'.format(
+            hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()))
+        try:
+            if os.stat(cache_path).st_mtime_ns >= mtime:
+                with open(cache_path, 'rb') as f:
+                    return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
 
-def _unzip_file(fname, download_path, keep=True):
+    # Parsed as plain dicts, with orjson if it is installed
+    with open(path, 'rb') as f:
+        footprint = _json_loads(f.read())
+    if cache_path is not None:
+        try:
+            tmp_path = '{}.tmp'.format(cache_path)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(footprint, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    return footprint
+
+
+def _read_footprint(path, cache_dir=None):
+    """Read a footprint geojson, which is parsed again only if it has been modified.
+    The geojson returned is shared, so do not modify it.
+
+    Args:
+        path (str): the path of footprint geojson.
+        cache_dir (str): the directory to pickle the geojson for later runs, optional.
+
+    Returns:
+        dict: the footprint geojson.
+    """
+    stat = os.stat(path)
+    return _parse_footprint(path, stat.st_mtime_ns, stat.st_size, cache_dir)
+
+
+def _extract_members(zip_path, names, download_path):
+    """Extract some members of a zip file with its own handle
+
+    Args:
+        zip_path (str): the path of the zip file.
+        names (list): the names of members to extract.
+        download_path (str): the path to extract files to.
+    """
+    with ZipFile(zip_path) as zip_file:
+        for name in names:
+            zip_file.extract(name, download_path)
+
+
+def _unzip_file(fname, download_path, keep=True, threads_number=None):
     """Unzip the file
+    Members are inflated by several threads, each with its own handle,
+    as zlib releases the GIL while decompressing.
 
     Args:
         download_path (str): the path to download files.
         fname (str): the name of file.
         keep (bool): the option to keep the zip raw file.
+        threads_number (int): the number of threads to unzip.
+            Default is None, which means CPU count.
     """
-    ZipFile(join(download_path, fname)).extractall(download_path)
+    zip_path = join(download_path, fname)
+    if threads_number is None:
+        threads_number = mp.cpu_count()
+    with ZipFile(zip_path) as zip_file:
+        infos = zip_file.infolist()
+        members = [info for info in infos if not info.is_dir()]
+        if threads_number <= 1 or len(members) <= 1:
+            zip_file.extractall(download_path)
+            members = []
+        else:
+            # Create all the folders first, so threads do not race to make them
+            for info in infos:
+                if info.is_dir():
+                    zip_file.extract(info, download_path)
+            for info in members:
+                upper_dir = os.path.dirname(info.filename)
+                if upper_dir and not os.path.isabs(upper_dir) \
+                        and '..' not in upper_dir.split('/'):
+                    os.makedirs(join(download_path, upper_dir), exist_ok=True)
+
+    if len(members) > 0:
+        # Deal the largest members out first to balance the threads
+        members.sort(key=lambda info: info.file_size, reverse=True)
+        n_chunks = min(len(members), threads_number)
+        unzip_executor = FixedThreadPoolExecutor(size=n_chunks)
+        for i in range(n_chunks):
+            unzip_executor.submit(_extract_members, zip_path,
+                                  [info.filename for info in members[i::n_chunks]],
+                                  download_path)
+        unzip_executor.drain()
+        unzip_executor.close()
+        unzip_executor.raise_first()
+
     if not keep:
-        os.remove(join(download_path, fname))
+        os.remove(zip_path)
 
 
-def _copytree(src, dst, symlinks=False, ignore=None):
-    """Unzip the file
+def _copy_file(src, dst, symlinks=False):
+    """Copy a file, or recreate it as a symlink
 
     Args:
         src (str): the source path.
         dst (str): the destination path.
         symlinks (bool): the option to use symlinks or not.
-        ignore (str): the ignore files.
     """
-    for item in os.listdir(src):
-        s = os.path.join(src, item)
-        d = os.path.join(dst, item)
-        if os.path.isdir(s):
-            shutil.copytree(s, d, symlinks, ignore)
-        else:
-            shutil.copy2(s, d)
+    if symlinks and os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+def _copytree(src, dst, symlinks=False, ignore=None, threads_number=None):
+    """Copy the content of a folder into another folder
+
+    Args:
+        src (str): the source path.
+        dst (str): the destination path.
+        symlinks (bool): the option to use symlinks or not.
+        ignore (callable): the ignore function as for shutil.copytree.
+        threads_number (int): the number of threads to copy files.
+            Default is None, which means 4 times of CPU count.
+    """
+    # Create the folders serially, then copy the files in parallel
+    pairs = []
+    for root, dirs, files in os.walk(src, followlinks=not symlinks):
+        if ignore is not None:
+            ignored = ignore(root, dirs + files)
+            dirs[:] = [d for d in dirs if d not in ignored]
+            files = [f for f in files if f not in ignored]
+        dst_root = join(dst, os.path.relpath(root, src))
+        os.makedirs(dst_root, exist_ok=True)
+        if symlinks:
+            # Keep linked folders as links instead of walking into them
+            links = [d for d in dirs if os.path.islink(join(root, d))]
+            dirs[:] = [d for d in dirs if d not in links]
+            files = files + links
+        pairs.extend((join(root, f), join(dst_root, f)) for f in files)
+    if len(pairs) == 0:
+        return
+
+    if threads_number is None:
+        threads_number = mp.cpu_count() * 4
+    cp_executor = FixedThreadPoolExecutor(size=min(len(pairs), threads_number))
+    for s, d in pairs:
+        cp_executor.submit(_copy_file, s, d, symlinks)
+    cp_executor.drain()
+    cp_executor.close()
+    cp_executor.raise_first()
 
 
 def _get_files_recursive(dir_name):
@@ -70,70 +342,257 @@ def _get_files_recursive(dir_name):
     Args:
         dir_name (str): the name of directory.
 
+    Yields:
+        str: the full path of each file in the folder.
+    """
+    # os.walk lists each directory with scandir, so no extra stat
+    # is needed to tell sub directories from files
+    for root, _, files in os.walk(dir_name):
+        for fname in files:
+            yield os.path.join(root, fname)
+
+
+def _split_cmd(cmd):
+    """Split a command line into arguments if it can run without a shell
+
+    Args:
+        cmd (str): a command line string.
+
     Returns:
-        list: all_files, a list of all files in the folder.
-    """
-    # create a list of file and sub directories
-    # names in the given directory
-    list_dir = os.listdir(dir_name)
-    all_files = list()
-    # Iterate over all the entries
-    for entry in list_dir:
-        # Create full path
-        full_path = os.path.join(dir_name, entry)
-        # If entry is a directory then get the list of files in this directory
-        if os.path.isdir(full_path):
-            all_files = all_files + _get_files_recursive(full_path)
+        list: the arguments, or None if the command line needs a shell,
+        e.g. it has pipes, command lists or globs.
+    """
+    if SHELL_CHARS.intersection(cmd):
+        return None
+    lexer = shlex.shlex(cmd, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        argv = list(lexer)
+    except ValueError:
+        return None
+    if len(argv) == 0 or any(set(arg) <= set(lexer.punctuation_chars) for arg in argv):
+        return None
+    return argv
+
+
+def _kill_child(proc):
+    """Kill a child process of _run_cmd with all the processes it started.
+
+    Args:
+        proc (subprocess.Popen): the child process.
+    """
+    if proc.poll() is not None:
+        return
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(proc.pid, signal.SIGTERM)
         else:
-            all_files.append(full_path)
-    return all_files
+            proc.kill()
+    except OSError:
+        pass
+
+
+def _kill_children():
+    """Kill the child processes of _run_cmd that are still running."""
+    with _children_lock:
+        children = list(_children)
+    for proc in children:
+        _kill_child(proc)
+
+
+atexit.register(_kill_children)
 
 
 def _run_cmd(cmd, logger=None):
-    """Using os to run a command line
+    """Run a command line
+    A simple command line runs without a shell,
+    while the one with shell syntax still goes through the shell.
+    The command runs in a session of its own, so the tools it starts,
+    e.g. the java of gpt, are stopped together with it when this exits.
 
     Args:
-        cmd (str): a command line string.
+        cmd (str or list): a command line string, or a list of arguments.
         logger (logging.Logger): the logger object to store logs.
 
     Returns:
         bool: True if success, otherwise False
     """
-    run_it = subprocess.Popen(cmd, shell=True).wait()
-    if run_it == 0:
+    argv = cmd if isinstance(cmd, list) else _split_cmd(cmd)
+    try:
+        # Only stderr is reported, so do not buffer the progress on stdout
+        proc = subprocess.Popen(cmd if argv is None else argv, shell=argv is None,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                start_new_session=True)
+    except OSError as e:
+        msg = str(e)
+        success = False
+    else:
+        with _children_lock:
+            _children.add(proc)
+        try:
+            _, stderr = proc.communicate()
+        except BaseException:
+            _kill_child(proc)
+            raise
+        finally:
+            with _children_lock:
+                _children.discard(proc)
+        msg = stderr.decode(errors='replace').strip()
+        success = proc.returncode == 0
+    if success:
         return True
     else:
         if logger is None:
-            print("Failed to run cmd {}.".format(cmd))
+            print("Failed to run cmd {}: {}".format(cmd, msg))
         else:
-            logger.error("Failed to run cmd {}.".format(cmd))
+            logger.error("Failed to run cmd {}: {}".format(cmd, msg))
         return False
 
 
-def _delete_files(fnames, logger=None):
+def _delete_file(fname, logger=None):
     """Delete the file given a specific path
 
     Args:
-        fnames (str): full path of file to delete.
+        fname (str): full path of file to delete.
+        logger (logging.Logger): the logger object to store logs.
+    """
+    try:
+        os.remove(fname)
+    except OSError as e:
+        if logger is None:
+            print("Removing {} fails: {} ".format(fname, e))
+        else:
+            logger.error("Removing {} fails: {} ".format(fname, e))
+
+
+def _delete_files(fnames, logger=None, threads_number=None):
+    """Delete the files given a list of specific paths
+
+    Args:
+        fnames (list): full paths of files to delete.
         logger (logging.Logger): the logger object to store logs.
+        threads_number (int): the number of threads to delete files.
+            Default is None, which means 4 times of CPU count.
     """
+    fnames = list(fnames)
+    if len(fnames) == 0:
+        return
+    if threads_number is None:
+        threads_number = mp.cpu_count() * 4
+    rm_executor = FixedThreadPoolExecutor(size=min(len(fnames), threads_number))
     for fname in fnames:
-        try:
-            os.remove(fname)
-        except OSError as e:
-            if logger is None:
-                print("Removing {} fails: {} ".format(fname, e))
+        rm_executor.submit(_delete_file, fname, logger)
+    rm_executor.drain()
+    rm_executor.close()
+
+
+def _rmtree(path, logger=None, threads_number=None):
+    """Delete a folder and all its content,
+    with the files deleted in parallel first
+
+    Args:
+        path (str): the path of folder to delete.
+        logger (logging.Logger): the logger object to store logs.
+        threads_number (int): the number of threads to delete files.
+            Default is None, which means 4 times of CPU count.
+    """
+    fnames = []
+    for root, dirs, files in os.walk(path):
+        fnames.extend(join(root, f) for f in files)
+        # Links to folders are not walked into, so delete them as files
+        fnames.extend(join(root, d) for d in dirs if os.path.islink(join(root, d)))
+    _delete_files(fnames, logger, threads_number)
+    # Only empty folders are left
+    shutil.rmtree(path)
+
+
+def _download_range(session, url, dst_path, start, end):
+    """Download a range of a file into its place in the destination.
+
+    Args:
+        session (requests.Session): the session to send requests.
+        url (str): the url of the file.
+        dst_path (str): the path of the destination, with its full size already.
+        start (int): the first byte of the range.
+        end (int): the last byte of the range.
+    """
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    with session.get(url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code != 206:
+            raise IOError("Range {}-{} is not served: HTTP {}".format(start, end, r.status_code))
+        with open(dst_path, 'r+b') as f:
+            f.seek(start)
+            for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+
+def _download_file(url, dst_path, logger=None, threads_number=DOWNLOAD_PARTS):
+    """Download a file over http.
+    A large file is downloaded in ranges at the same time if the server accepts ranges,
+    otherwise in one stream, which resumes a partial download left before.
+
+    Args:
+        url (str): the url of the file.
+        dst_path (str): the path to save the file.
+        logger (logging.Logger): the logger object to store logs.
+        threads_number (int): the number of ranges downloaded at the same time.
+
+    Returns:
+        bool: True if the file is downloaded, otherwise False.
+    """
+    part_path = dst_path + '.part'
+    try:
+        with requests.Session() as session:
+            r = session.head(url, allow_redirects=True, timeout=60)
+            r.raise_for_status()
+            url = r.url
+            size = int(r.headers.get('Content-Length', 0))
+            accept_ranges = r.headers.get('Accept-Ranges') == 'bytes'
+            if accept_ranges and size >= DOWNLOAD_PART_MIN_SIZE and threads_number > 1:
+                with open(part_path, 'wb') as f:
+                    f.truncate(size)
+                part_size = -(-size // threads_number)
+                download_executor = FixedThreadPoolExecutor(size=threads_number)
+                for start in range(0, size, part_size):
+                    download_executor.submit(_download_range, session, url, part_path,
+                                             start, min(start + part_size, size) - 1)
+                download_executor.drain()
+                download_executor.close()
+                download_executor.raise_first()
             else:
-                logger.error("Removing {} fails: {} ".format(fname, e))
+                # Resume from what is left by a failed download
+                done = os.path.getsize(part_path) if os.path.exists(part_path) and accept_ranges else 0
+                if size == 0 or done < size:
+                    headers = {'Range': 'bytes={}-'.format(done)} if done > 0 else {}
+                    with session.get(url, headers=headers, stream=True, timeout=60) as r:
+                        r.raise_for_status()
+                        mode = 'ab' if r.status_code == 206 else 'wb'
+                        with open(part_path, mode) as f:
+                            for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                                f.write(chunk)
+        os.replace(part_path, dst_path)
+        return True
+    except (requests.RequestException, IOError) as e:
+        if logger is None:
+            print("Failed to download {}: {}".format(url, e))
+        else:
+            logger.error("Failed to download {}: {}".format(url, e))
+        return False
 
 
 def _divide_chunks(l, n):
     """Split a list with fixed length
 
     Args:
-        l (list): the list to be split.
+        l (list or numpy.ndarray): the list to be split.
         n (int): the length of sub-lists.
+
+    Returns:
+        list of numpy.ndarray of views if l is an array,
+        otherwise a generator of sub-lists.
     """
+    if isinstance(l, np.ndarray):
+        # Split the array into views at every n items, without copying
+        return np.split(l, range(n, len(l), n))
     # looping till length l
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
+    return (l[i:i + n] for i in range(0, len(l), n))
@@ -7,8 +7,8 @@ https://github.com/olivierhagolle/maja_peps and
 https://github.com/olivierhagolle/peps_download
 Maintainer: Lei Song (lsong@clarku.edu)
 """
+import hashlib
 import json
-import logging
 import optparse
 import os
 import os.path
@@ -17,12 +17,62 @@ import shutil
 import sys
 import time
 import zipfile
+from collections import Counter
 from datetime import date, datetime
 from os.path import exists, join
-from .internal_functions import _divide_chunks
+from threading import BoundedSemaphore
+from .internal_functions import _divide_chunks, _load_yaml, _setup_logging, \
+    _json_loads, _json_dumps
+from .fixed_thread_pool_executor import FixedThreadPoolExecutor
 import geojson
+import numpy as np
 import requests
-import yaml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# The url templates of peps catalog search and product download
+PEPS_SEARCH_URL = "https://peps.cnes.fr/resto/api/collections/{}/search.json"
+PEPS_DOWNLOAD_URL = "https://peps.cnes.fr/resto/collections/{}/{}/download/?issuerId=peps"
+# The url templates of maja requests, job logs and results
+MAJA_WPS_URL = "http://peps.cnes.fr/resto/wps?request=execute&service=WPS&version=1.0.0" \
+               "&identifier=FULL_MAJA&datainputs=startDate={start};completionDate={end};" \
+               "tileid={tile}{orbit}&status=true&storeExecuteResponse=true"
+MAJA_JOBLOG_URL = "https://peps.cnes.fr/cgi-bin/mapcache_results/logs/joblog-{}.log"
+MAJA_RESULTS_URL = "https://peps.cnes.fr/cgi-bin/mapcache_results/maja/{}"
+# The number of catalog queries in flight at a time
+QUERY_THREADS = 8
+# The timeout in seconds of a catalog query
+QUERY_TIMEOUT = 60
+# The number of retries of a failed request to peps
+HTTP_RETRIES = 5
+# The size in bytes of chunks to write downloads
+CHUNK_SIZE = 1 << 20
+# The timeout in seconds of waiting for a download to respond
+DOWNLOAD_TIMEOUT = 300
+# The number of products to download at a time
+DOWNLOAD_THREADS = 4
+# The first and the longest seconds to wait for products on tape
+TAPE_WAIT_MIN = 15
+TAPE_WAIT_MAX = 300
+# The first and the longest seconds to wait between polls of maja results
+MAJA_WAIT_MIN = 30
+MAJA_WAIT_MAX = 300
+# The seconds to reuse a cached catalog query
+CATALOG_CACHE_TTL = 3600
+# The first date of products in sentinel-2 tiled collection S2ST
+S2ST_START = date(2016, 12, 5)
+# The first date to process by maja
+MAJA_START = date(2016, 4, 1)
+# Offsets to get the relative orbit from the orbit number of Sentinel 1
+S1_ORBIT_OFFSETS = {'S1A': 73, 'S1B': 27}
+# The format of MGRS tile ID
+RE_TILE = re.compile("^[0-6][0-9][A-Za-z]([A-Za-z]){0,2}%?$")
+# The tile ID in the name of a sentinel-2 product
+RE_PROD_TILE = re.compile("T[0-9]{2}[A-Z]{3}")
+# The url of a maja product in its status log
+RE_ZIP_URL = re.compile('https:(.+).zip')
+# The maja products downloaded at a time, shared by the tiles polled together
+_maja_download_slots = BoundedSemaphore(DOWNLOAD_THREADS)
 
 
 class OptionParser(optparse.OptionParser):
@@ -41,34 +91,72 @@ class OptionParser(optparse.OptionParser):
 class GeoJSON:
     """GeoJSON class which allows to calculate bbox
     Attributes:
-        coords (list): the list of coordinates.
+        coords (numpy.ndarray): the array of coordinates with shape (N, 2).
         features_count (int): the number of features.
     """
 
     def __init__(self, gj_object):
         if gj_object['type'] == 'FeatureCollection':
-            self.coords = list(self._flatten([f['geometry']['coordinates']
-                                              for f in gj_object['features']]))
+            self.coords = self._collect_coords([f['geometry']['coordinates']
+                                                for f in gj_object['features']])
             self.features_count = len(gj_object['features'])
         elif gj_object['type'] == 'Feature':
-            self.coords = list(self._flatten([
-                gj_object['geometry']['coordinates']]))
+            self.coords = self._collect_coords([
+                gj_object['geometry']['coordinates']])
             self.features_count = 1
         else:
-            self.coords = list(self._flatten([gj_object['coordinates']]))
+            self.coords = self._collect_coords([gj_object['coordinates']])
             self.features_count = 1
 
-    def _flatten(self, l):
-        for val in l:
-            if isinstance(val, list):
-                for subval in self._flatten(val):
-                    yield subval
+    def _collect_coords(self, l):
+        """Gather the positions of nested coordinates into one array.
+        Each list of positions is converted as a whole,
+        instead of walking every single number.
+
+        Args:
+            l (list): the nested coordinates.
+
+        Returns:
+            numpy.ndarray: the x and y of positions with shape (N, 2).
+        """
+        arrays = []
+        self._collect_positions(l, arrays)
+        if len(arrays) == 0:
+            return np.empty((0, 2))
+        if len(arrays) == 1:
+            # e.g. a polygon without holes, no need to copy
+            return arrays[0]
+        return np.vstack(arrays)
+
+    def _collect_positions(self, l, arrays):
+        """Append the lists of positions in nested coordinates to arrays.
+
+        Args:
+            l (list): the nested coordinates.
+            arrays (list): the list to append arrays of positions.
+        """
+        # Walk with an explicit stack of iterators instead of recursion
+        stack = [iter([l])]
+        while stack:
+            for val in stack[-1]:
+                if len(val) == 0:
+                    continue
+                if not isinstance(val[0], (list, tuple)):
+                    # A single position
+                    arrays.append(np.asarray(val, dtype=np.float64)[:2].reshape(1, 2))
+                elif not isinstance(val[0][0], (list, tuple)):
+                    # A list of positions
+                    arrays.append(np.asarray(val, dtype=np.float64)[:, :2])
+                else:
+                    stack.append(iter(val))
+                    break
             else:
-                yield val
+                stack.pop()
 
     def bbox(self):
-        return [min(self.coords[::2]), min(self.coords[1::2]),
-                max(self.coords[::2]), max(self.coords[1::2])]
+        # [xmin, ymin, xmax, ymax]
+        return np.concatenate([self.coords.min(axis=0),
+                               self.coords.max(axis=0)]).tolist()
 
 
 class ParserConfig:
@@ -94,6 +182,7 @@ class ParserConfig:
             windows (bool): For windows usage, True if use, otherwise False.
             extract (bool): Extract and remove zip file after download.
             search_json_file (str): Output search JSON filename.
+            catalog_cache_ttl (int): Seconds to reuse a cached catalog query.
             sat (str): satellite, S1A, S1B, S2A, S2B, S3A, S3B.
             orbit (int): Orbit Path number.
             maja_log (str): path to store log file of maja.
@@ -168,114 +257,206 @@ class ParserConfig:
         self.windows = config['windows']
         self.extract = config['extract']
         self.search_json_file = config['catalog_json']
+        self.catalog_cache_ttl = config.get('catalog_cache_ttl')
+        if self.catalog_cache_ttl is None:
+            self.catalog_cache_ttl = CATALOG_CACHE_TTL
         self.sat = config['satellite']
         self.orbit = config['orbit']
 
 
 def parse_config(auth_file_path):
     """The script to parse config yaml.
+    The parsed config is cached until the file changes.
 
     Args:
         auth_file_path (str): the path of yaml file.
     """
-    with open(auth_file_path, 'r') as yaml_file:
-        config = yaml.safe_load(yaml_file)
-        return config
+    return _load_yaml(auth_file_path)
+
+
+def _search_params(options, query_geom, start_date, end_date):
+    """Build the parameters of a catalog query.
+
+    Args:
+        options (ParserConfig): the config object.
+        query_geom (dict): the geom parameters for query.
+        start_date (str): the start date to query.
+        end_date (str): the end date to query.
+
+    Returns:
+        dict: the parameters of the query.
+    """
+    params = dict(query_geom)
+    params['startDate'] = start_date
+    params['completionDate'] = end_date
+    params['maxRecords'] = 500
+    if (options.product_type is not None) or (options.sensor_mode is not None):
+        params['productType'] = "" if options.product_type is None else options.product_type
+        params['sensorMode'] = "" if options.sensor_mode is None else options.sensor_mode
+    return params
+
+
+def _search_feature(session, search_url, params, i, logger):
+    """Query the catalog for one feature of a geojson.
+
+    Args:
+        session (requests.Session): the session for the query.
+        search_url (str): the url of the query.
+        params (dict): the parameters of the query.
+        i (int): the index of the feature.
+        logger (logging.Logger): the logger object to store logs.
+
+    Returns:
+        list: the products found, tagged by the index of the feature,
+        or None if the query fails.
+    """
+    try:
+        json_each = _json_loads(session.get(search_url, params=params,
+                                            timeout=QUERY_TIMEOUT).content)
+    except (requests.RequestException, ValueError):
+        logger.warning("Failed to search for the %sth tile.", i)
+        return None
+    if 'ErrorCode' in json_each:
+        logger.error("Error in query of %sth feature: %s",
+                     i, json_each['ErrorMessage'])
+        return None
+    for feature in json_each['features']:
+        feature['properties']['no_geom'] = i
+    return json_each['features']
+
+
+def _catalog_cache_path(options, query_geom, start_date, end_date):
+    """Get the path to cache a catalog query, named by the hash of the query.
+
+    Args:
+        options (ParserConfig): the config object.
+        query_geom (list or dict): the geom for query.
+        start_date (str): the start date to query.
+        end_date (str): the end date to query.
+
+    Returns:
+        str: the path of the cached catalog.
+    """
+    query = json.dumps([options.collection, query_geom, start_date, end_date,
+                        options.product_type, options.sensor_mode],
+                       sort_keys=True, default=str)
+    if options.log_dir is None:
+        cache_dir = join(options.dst_dir, 'catalog_cache')
+    else:
+        cache_dir = join(options.dst_dir, options.log_dir, 'catalog_cache')
+    return join(cache_dir, '{}.json'.format(hashlib.sha1(query.encode('utf-8')).hexdigest()))
 
 
-def _query_catalog(options, query_geom, start_date, end_date, logger):
+def _query_catalog(options, query_geom, start_date, end_date, logger, use_cache=True):
     """The script to query catalog from peps.
+    The result of a query is cached, and reused by the same query
+    within options.catalog_cache_ttl seconds.
 
     Args:
         options (ParserConfig): the config object.
-        query_geom (list or str): the geom for query.
+        query_geom (list or dict): the geom for query, a list of bbox
+            for a geojson with multiple features, otherwise the geom parameters.
         start_date (str): the start date to query.
         end_date (str): the end date to query.
         logger (logging.Logger): the logger object to store logs.
+        use_cache (bool): the option to reuse a cached query. Set False to
+            get the latest status of products, the result is still cached.
     """
+    cache_path = _catalog_cache_path(options, query_geom, start_date, end_date)
+    if use_cache and exists(cache_path) and \
+            time.time() - os.path.getmtime(cache_path) < options.catalog_cache_ttl:
+        shutil.copyfile(cache_path, options.search_json_file)
+        logger.info("Reuse cached search json %s.", cache_path)
+        return
+
+    search_url = PEPS_SEARCH_URL.format(options.collection)
+    session = _peps_session()
+    cache_it = True
+
     # Parse catalog
     # If the query geom is a geojson with more than 1 feature
     if isinstance(query_geom, list):
         logger.info('Query based on geojson with multiple features.')
-        json_file_tmp = 'tmp.json'
         json_all = {"type": "FeatureCollection",
                     "properties": {},
                     "features": []}
+        # Features are queried concurrently, with a few requests in flight
+        query_executor = FixedThreadPoolExecutor(size=min(len(query_geom), QUERY_THREADS))
         for i in range(0, len(query_geom)):
             each = query_geom[i]
             latmin = each[1]
             latmax = each[3]
             lonmin = each[0]
             lonmax = each[2]
-            query_geom_each = 'box={lonmin},{latmin},{lonmax},{latmax}' \
-                .format(latmin=latmin, latmax=latmax,
-                        lonmin=lonmin, lonmax=lonmax)
-            if (options.product_type is None) and (options.sensor_mode is None):
-                search_catalog = "curl -k -o {} https://peps.cnes.fr/resto/api/" \
-                                 "collections/{}/search.json?{}\&startDate={}" \
-                                 "\&completionDate={}\&maxRecords=500" \
-                    .format(json_file_tmp, options.collection,
-                            query_geom_each, start_date, end_date)
+            query_geom_each = {'box': '{lonmin},{latmin},{lonmax},{latmax}'
+                               .format(latmin=latmin, latmax=latmax,
+                                       lonmin=lonmin, lonmax=lonmax)}
+            params = _search_params(options, query_geom_each, start_date, end_date)
+            query_executor.submit(_search_feature, session, search_url, params, i, logger)
+        query_executor.drain()
+        query_executor.close()
+        # Keep the order of features
+        for features in query_executor.returns:
+            if features is None:
+                # Do not cache an incomplete catalog
+                cache_it = False
             else:
-                product_type = "" if options.product_type is None else options.product_type
-                sensor_mode = "" if options.sensor_mode is None else options.sensor_mode
-                search_catalog = 'curl -k -o {} https://peps.cnes.fr/resto/api/' \
-                                 'collections/{}/search.json?{}\&startDate={}' \
-                                 '\&completionDate={}\&maxRecords=500' \
-                                 '\&productType={}\&sensorMode={}' \
-                    .format(json_file_tmp, options.collection,
-                            query_geom_each, start_date, end_date,
-                            product_type, sensor_mode)
-            if options.windows:
-                search_catalog = search_catalog.replace('\&', '^&')
-            os.system(search_catalog)
-            time.sleep(5)
-
-            try:
-                with open(json_file_tmp) as data_file:
-                    json_each = json.load(data_file)
-                    if 'ErrorCode' in json_each:
-                        logger.error("Error in query of {}th feature: {}"
-                                     .format(i, json_each['ErrorMessage']))
-                    else:
-                        for n in range(0, len(json_each['features'])):
-                            json_each['features'][n]['properties']['no_geom'] = i
-                        json_all['features'].extend(json_each['features'])
-                os.remove(json_file_tmp)
-            except OSError:
-                logger.warn("Failed to search for the {}th tile.".format(i))
+                json_all['features'].extend(features)
+        # Features failed with an unexpected error are missing too
+        for e in query_executor.exceptions:
+            logger.error("Error in query of a feature: %s", e)
+            cache_it = False
 
         # Write json_all as search_json_file
-        with open(options.search_json_file, 'w') as f:
-            json.dump(json_all, f)
-        logger.info("Write gathered search json to {}.".format(options.search_json_file))
+        with open(options.search_json_file, 'wb') as f:
+            f.write(_json_dumps(json_all))
+        logger.info("Write gathered search json to %s.", options.search_json_file)
 
     # Regular condition
     else:
         logger.info("Query based on regular conditions.")
-        if (options.product_type is None) and (options.sensor_mode is None):
-            search_catalog = "curl -k -o {} https://peps.cnes.fr/resto/api/" \
-                             "collections/{}/search.json?{}\&startDate={}" \
-                             "\&completionDate={}\&maxRecords=500" \
-                .format(options.search_json_file, options.collection,
-                        query_geom, start_date, end_date)
-        else:
-            product_type = "" if options.product_type is None else options.product_type
-            sensor_mode = "" if options.sensor_mode is None else options.sensor_mode
-            search_catalog = 'curl -k -o {} https://peps.cnes.fr/resto/api/' \
-                             'collections/{}/search.json?{}\&startDate={}' \
-                             '\&completionDate={}\&maxRecords=500' \
-                             '\&productType={}\&sensorMode={}' \
-                .format(options.search_json_file, options.collection,
-                        query_geom, start_date, end_date,
-                        product_type, sensor_mode)
+        params = _search_params(options, query_geom, start_date, end_date)
+        try:
+            req = session.get(search_url, params=params, timeout=QUERY_TIMEOUT)
+        except requests.RequestException as e:
+            logger.error("Failed to search catalog: %s", e)
+            return
+        logger.info(req.url)
+        # Save the response as it is, parse_catalog reads it
+        with open(options.search_json_file, 'wb') as f:
+            f.write(req.content)
+        cache_it = req.status_code == 200
 
-        if options.windows:
-            search_catalog = search_catalog.replace('\&', '^&')
+    if cache_it:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        shutil.copyfile(options.search_json_file, cache_path)
 
-        logger.info(search_catalog)
-        os.system(search_catalog)
-        time.sleep(5)
+
+def _extract_zip(zfile, write_dir):
+    """Extract a zip file, copying members with a large buffer.
+
+    Args:
+        zfile (str): the path of zip file.
+        write_dir (str): the path to extract files to.
+
+    Returns:
+        str: the name of the top directory in the zip file.
+    """
+    write_dir = os.path.realpath(write_dir)
+    with zipfile.ZipFile(zfile, 'r') as zf:
+        infos = zf.infolist()
+        safename = infos[0].filename.split('/', 1)[0]
+        for info in infos:
+            target = os.path.realpath(join(write_dir, info.filename))
+            if not target.startswith(write_dir + os.sep):
+                raise Exception('Path out of the directory in zip file: ', info.filename)
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with zf.open(info) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    return safename
 
 
 def check_rename(tmpfile, options, prod, prodsize, logger):
@@ -288,8 +469,9 @@ def check_rename(tmpfile, options, prod, prodsize, logger):
         prodsize (int): the correct size of full imagery.
         logger (logging.Logger): the logger object to store logs.
     """
-    logger.info("{} {}".format(os.path.getsize(tmpfile), prodsize))
-    if os.path.getsize(tmpfile) != prodsize:
+    tmpsize = os.path.getsize(tmpfile)
+    logger.info("%s %s", tmpsize, prodsize)
+    if tmpsize != prodsize:
         with open(tmpfile) as f_tmp:
             try:
                 tmp_data = json.load(f_tmp)
@@ -307,24 +489,108 @@ def check_rename(tmpfile, options, prod, prodsize, logger):
     # Unzip file
     if options.extract and os.path.exists(zfile):
         try:
-            with zipfile.ZipFile(zfile, 'r') as zf:
-                safename = zf.namelist()[0].replace('/', '')
-                zf.extractall(options.write_dir)
+            safename = _extract_zip(zfile, options.write_dir)
             safedir = os.path.join(options.write_dir, safename)
             if not os.path.isdir(safedir):
                 raise Exception('Unzipped directory not found: ', zfile)
 
         except Exception as e:
             logger.warning(e)
-            logger.warning('Could not unzip file: ' + zfile)
+            logger.warning('Could not unzip file: %s', zfile)
             os.remove(zfile)
             logger.warning('Zip file removed.')
             return
         else:
-            logger.info('Product saved as : ' + safedir)
+            logger.info('Product saved as : %s', safedir)
             os.remove(zfile)
             return
-    logger.info("Product saved as : " + zfile)
+    logger.info("Product saved as : %s", zfile)
+
+
+def _list_products(write_dir):
+    """List the names in the download folder with a single scan.
+
+    Args:
+        write_dir (str): the download folder.
+
+    Returns:
+        set: the names of files and folders in write_dir.
+    """
+    with os.scandir(write_dir) as entries:
+        return {entry.name for entry in entries}
+
+
+def _downloaded_products(write_dir):
+    """List the products already downloaded or extracted with a single scan.
+
+    Args:
+        write_dir (str): the download folder.
+
+    Returns:
+        set: the names of products with a .SAFE folder or .zip file in write_dir.
+    """
+    products = set()
+    with os.scandir(write_dir) as entries:
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext in ('.SAFE', '.zip'):
+                products.add(name)
+    return products
+
+
+def _stage_product(options, prod, feature_id, session, logger):
+    """Ask peps to stage a product on tape to disk.
+    Requesting the download is enough to trigger the staging,
+    so the response is closed without reading the body.
+
+    Args:
+        options (ParserConfig): the config object.
+        prod (str): the name of imagery.
+        feature_id (str): the peps id of imagery.
+        session (requests.Session): the authenticated session.
+        logger (logging.Logger): the logger object to store logs.
+    """
+    url = PEPS_DOWNLOAD_URL.format(options.collection, feature_id)
+    try:
+        with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT):
+            pass
+    except requests.RequestException as e:
+        logger.warning("Failed to stage %s: %s", prod, e)
+
+
+def _download_product(options, prod, feature_id, prodsize, session, logger):
+    """Download a product on disk from peps.
+
+    Args:
+        options (ParserConfig): the config object.
+        prod (str): the name of imagery.
+        feature_id (str): the peps id of imagery.
+        prodsize (int): the correct size of full imagery.
+        session (requests.Session): the authenticated session shared by downloads.
+        logger (logging.Logger): the logger object to store logs.
+
+    Returns:
+        bool: False if nothing is downloaded and it needs another try, otherwise True.
+    """
+    # Name the temp file by product, so concurrent downloads do not collide
+    tmpfile = "{}/tmp_{}.tmp".format(options.write_dir, prod)
+    logger.info("Download of product : %s", prod)
+    url = PEPS_DOWNLOAD_URL.format(options.collection, feature_id)
+    try:
+        downloadFile(url, tmpfile, None, None, session)
+    except requests.RequestException as e:
+        logger.warning("Failed to download %s: %s", prod, e)
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        return False
+    # check binary product, rename tmp file
+    try:
+        check_rename(tmpfile, options, prod, prodsize, logger)
+    except SystemExit:
+        # Raise an error instead, so it gets out of the worker thread
+        raise RuntimeError("Failed to download {}, it might come from "
+                           "a wrong password file.".format(prod))
+    return True
 
 
 def check_params(begin_date, stop_date, tileid, orbit=None):
@@ -337,16 +603,12 @@ def check_params(begin_date, stop_date, tileid, orbit=None):
         orbit (int): relative orbit number
     """
     # Check dates
-    begin_date = begin_date.split("-")
-    stop_date = stop_date.split("-")
-    if len(begin_date[0]) != 4 or len(begin_date[1]) != 2 or \
-            len(begin_date[2]) != 2 or len(stop_date[0]) != 4 or \
-            len(stop_date[1]) != 2 or len(stop_date[2]) != 2:
+    try:
+        begin_date = date.fromisoformat(str(begin_date))
+        stop_date = date.fromisoformat(str(stop_date))
+    except ValueError:
         raise ValueError("The date format is incorrect")
 
-    begin_date = datetime(int(begin_date[0]), int(begin_date[1]), int(begin_date[2]))
-    stop_date = datetime(int(stop_date[0]), int(stop_date[1]), int(stop_date[2]))
-
     days = (stop_date - begin_date).days
 
     if days < 55 or days > 366:
@@ -358,12 +620,38 @@ def check_params(begin_date, stop_date, tileid, orbit=None):
             raise ValueError("The relative orbit number must be between 1 and 143")
 
     # Check tile regex
-    re_tile = re.compile("^[0-6][0-9][A-Za-z]([A-Za-z]){0,2}%?$")
-    if not re_tile.match(tileid):
+    if not RE_TILE.match(tileid):
         raise ValueError("The tile ID is in the wrong format")
 
 
-def downloadFile(url, file_name, email, password):
+def _peps_session(email=None, password=None):
+    """Create a session for peps requests,
+    so connections are kept alive and reused between requests.
+
+    Args:
+        email (str): peps email, None for anonymous requests.
+        password (str): peps password.
+
+    Returns:
+        requests.Session: the session.
+    """
+    session = requests.Session()
+    # Retry transient failures of the server, and keep the last response
+    # when retries run out, so callers still check its status code
+    retries = Retry(total=HTTP_RETRIES, backoff_factor=1,
+                    status_forcelist=(500, 502, 503, 504),
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                          max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if email is not None:
+        session.auth = (email, password)
+    session.verify = False
+    return session
+
+
+def downloadFile(url, file_name, email, password, session=None):
     """Download file
 
     Args:
@@ -371,13 +659,17 @@ def downloadFile(url, file_name, email, password):
         file_name (str): the file name.
         email (str): peps email.
         password (str): peps password.
+        session (requests.Session): the session to reuse, optional.
     """
-    r = requests.get(url, auth=(email, password), stream=True, verify=False)
-    with open(file_name, 'wb') as f:
-        shutil.copyfileobj(r.raw, f)
+    if session is None:
+        session = _peps_session(email, password)
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        with open(file_name, 'wb') as f:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                f.write(chunk)
 
 
-def getURL(url, file_name, email, password, logger):
+def getURL(url, file_name, email, password, logger, session=None):
     """Get URL
 
     Args:
@@ -386,8 +678,11 @@ def getURL(url, file_name, email, password, logger):
         email (str): peps email.
         password (str): peps password.
         logger (logging.Logger): logger object to store logs.
+        session (requests.Session): the session to reuse, optional.
     """
-    req = requests.get(url, auth=(email, password), verify=False)
+    if session is None:
+        session = _peps_session(email, password)
+    req = session.get(url)
     with open(file_name, "w") as f:
         if sys.version_info[0] < 3:
             f.write(req.text.encode('utf-8'))
@@ -396,10 +691,35 @@ def getURL(url, file_name, email, password, logger):
         if req.status_code == 200:
             logger.info("Request OK.")
         else:
-            logger.error("Wrong request status {}".format(str(req.status_code)))
+            logger.error("Wrong request status %s", req.status_code)
             sys.exit(-1)
 
 
+def _orbit_matcher(orbit):
+    """Build the predicate of the relative orbit criteria once.
+
+    Args:
+        orbit (int): the relative orbit number, None to keep all products.
+
+    Returns:
+        function: takes platform, product id and properties of a product,
+            and returns True if the product is on the orbit.
+    """
+    if orbit is None:
+        return lambda platform, prod, properties: True
+    s2_orbit = "_R%03d" % orbit
+
+    def match(platform, prod, properties):
+        if platform.startswith('S2'):
+            return prod.find(s2_orbit) > 0
+        offset = S1_ORBIT_OFFSETS.get(platform)
+        if offset is None:
+            return False
+        # calculate relative orbit from the absolute orbit number
+        return ((properties["orbitNumber"] - offset) % 175) + 1 == orbit
+    return match
+
+
 def parse_catalog(options, logger):
     """The script to parse search json.
 
@@ -408,8 +728,8 @@ def parse_catalog(options, logger):
         logger (logging.Logger): the logger object to store logs.
     """
     # Filter catalog result
-    with open(options.search_json_file) as data_file:
-        data = json.load(data_file)
+    with open(options.search_json_file, 'rb') as data_file:
+        data = _json_loads(data_file.read())
 
     if 'ErrorCode' in data:
         logger.error(data['ErrorMessage'])
@@ -422,11 +742,16 @@ def parse_catalog(options, logger):
             del data['features'][i]['properties']['no_geom']
     except:
         pass
-    # Remove duplicates
+    # Remove duplicates by product id in a single pass,
+    # the whole feature is the key in case id is missing
+    seen = set()
     result = []
-    for i in range(0, len(data['features'])):
-        each = data['features'][i]
-        if each not in result:
+    for each in data['features']:
+        key = each.get('id')
+        if key is None:
+            key = json.dumps(each, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
             result.append(each)
     data['features'] = result
 
@@ -435,65 +760,43 @@ def parse_catalog(options, logger):
     storage_dict = {}
     size_dict = {}
     if len(data["features"]) > 0:
-        for i in range(len(data["features"])):
-            prod = data["features"][i]["properties"]["productIdentifier"]
-            feature_id = data["features"][i]["id"]
+        # cloud cover criteria:
+        check_clouds = options.collection[0:2] == 'S2'
+        if check_clouds:
+            logger.info("Check cloud cover criteria.")
+
+        match_orbit = _orbit_matcher(options.orbit)
+
+        # Check all criteria of each product in a single pass,
+        # and keep the product only if it meets all of them
+        for feature in data["features"]:
+            properties = feature["properties"]
+            prod = properties["productIdentifier"]
             try:
-                storage = data["features"][i]["properties"]["storage"]["mode"]
-                platform = data["features"][i]["properties"]["platform"]
-                resourceSize = int(data["features"][i]["properties"]["resourceSize"])
+                storage = properties["storage"]["mode"]
+                platform = properties["platform"]
+                resourceSize = int(properties["resourceSize"])
                 if storage == "unknown":
-                    logger.error('Found a product with "unknown" status : %s' % prod)
-                    logger.error("Product %s cannot be downloaded" % prod)
+                    logger.error('Found a product with "unknown" status : %s', prod)
+                    logger.error("Product %s cannot be downloaded", prod)
                     logger.error('Please send and email with product name to peps admin team : exppeps@cnes.fr')
-                else:
-                    # parse the orbit number
-                    orbitN = data["features"][i]["properties"]["orbitNumber"]
-                    if platform == 'S1A':
-                        # calculate relative orbit for Sentinel 1A
-                        relativeOrbit = ((orbitN - 73) % 175) + 1
-                    elif platform == 'S1B':
-                        # calculate relative orbit for Sentinel 1B
-                        relativeOrbit = ((orbitN - 27) % 175) + 1
-
-                    if options.orbit is not None:
-                        if platform.startswith('S2'):
-                            if prod.find("_R%03d" % options.orbit) > 0:
-                                download_dict[prod] = feature_id
-                                storage_dict[prod] = storage
-                                size_dict[prod] = resourceSize
-                        elif platform.startswith('S1'):
-                            if relativeOrbit == options.orbit:
-                                download_dict[prod] = feature_id
-                                storage_dict[prod] = storage
-                                size_dict[prod] = resourceSize
-                    else:
-                        download_dict[prod] = feature_id
-                        storage_dict[prod] = storage
-                        size_dict[prod] = resourceSize
-            except:
-                pass
-
-        # cloud cover criteria:
-        if options.collection[0:2] == 'S2':
-            logger.info("Check cloud cover criteria.")
-            for i in range(len(data["features"])):
-                prod = data["features"][i]["properties"]["productIdentifier"]
-                if data["features"][i]["properties"]["cloudCover"] > options.clouds:
-                    del download_dict[prod], storage_dict[prod], size_dict[prod]
-
-        # Selection of specific satellite
-        if options.sat is not None:
-            for i in range(len(data["features"])):
-                prod = data["features"][i]["properties"]["productIdentifier"]
-                if data["features"][i]["properties"]["platform"] != options.sat:
-                    try:
-                        del download_dict[prod], storage_dict[prod], size_dict[prod]
-                    except KeyError:
-                        pass
-
-        for prod in download_dict.keys():
-            logger.info("{} {}".format(prod, storage_dict[prod]))
+                    continue
+                if check_clouds and properties["cloudCover"] > options.clouds:
+                    continue
+                # Selection of specific satellite
+                if options.sat is not None and platform != options.sat:
+                    continue
+
+                if not match_orbit(platform, prod, properties):
+                    continue
+            except (KeyError, TypeError, ValueError):
+                continue
+            download_dict[prod] = feature["id"]
+            storage_dict[prod] = storage
+            size_dict[prod] = resourceSize
+
+        for prod in download_dict:
+            logger.info("%s %s", prod, storage_dict[prod])
     else:
         logger.warning("No product corresponds to selection criteria")
         sys.exit(-1)
@@ -506,6 +809,10 @@ def peps_downloader(options):
 
     Args:
         options (ParserConfig): the config object.
+
+    Returns:
+        tuple: the latest catalog parsed by `parse_catalog`,
+            as (prod, download_dict, storage_dict, size_dict).
     """
     # Set logging
     if options.log_dir is not None:
@@ -518,73 +825,51 @@ def peps_downloader(options):
             .format(options.dst_dir,
                     datetime.now().strftime("%d%m%Y_%H%M"))
     # Set up logger
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-    log_format = "%(asctime)s::%(levelname)s::%(name)s::%(filename)s::%(lineno)d::%(message)s"
-    logging.basicConfig(filename=log, filemode='w',
-                        level=logging.INFO, format=log_format)
-    logger = logging.getLogger(__name__)
+    logger = _setup_logging(log, __name__)
 
     # Check destination path
     if options.dst_dir is None:
         logger.error("peps_downloader: must set a destination path for results.")
         sys.exit("peps_downloader: must set a destination path for results.")
-    if not exists(options.write_dir):
-        os.mkdir(options.write_dir)
+    os.makedirs(options.write_dir, exist_ok=True)
 
     # Initialize json file for searching
     if options.search_json_file is None or options.search_json_file == "":
         options.search_json_file = 'search.json'
 
     if options.sat is not None:
-        logger.info("{} {}".format(options.sat, options.collection[0:2]))
+        logger.info("%s %s", options.sat, options.collection[0:2])
         if not options.sat.startswith(options.collection[0:2]):
             print("Input parameters collection and satellite are incompatible")
             logger.error("Input parameters collection and satellite are incompatible")
             sys.exit(-1)
 
-    # Define location for searching: location, point or rectangle
-    if options.tile is None:
-        if options.geojson is None:
-            if options.location is None:
-                if options.lat is None or options.lon is None:
-                    if options.latmin is None or options.lonmin is None or \
-                            options.latmax is None or options.lonmax is None:
-                        print("Provide at least tile, location, coordinates, rectangle, or geojson")
-                        logger.error("Provide at least tile, location, coordinates, rectangle, or geojson")
-                        sys.exit(-1)
-                    else:
-                        geom = 'rectangle'
-                else:
-                    if options.latmin is None and options.lonmin is None and \
-                            options.latmax is None and options.lonmax is None:
-                        geom = 'point'
-                    else:
-                        print("Please choose between coordinates and rectangle, but not both")
-                        logger.error("Please choose between coordinates and rectangle, but not both")
-                        sys.exit(-1)
-            else:
-                if options.latmin is None and options.lonmin is None and \
-                        options.latmax is None and options.lonmax is None and \
-                        options.lat is None or options.lon is None:
-                    geom = 'location'
-                else:
-                    print("Please choose location and coordinates, but not both")
-                    logger.error("Please choose location and coordinates, but not both")
-                    sys.exit(-1)
-        else:
-            if options.latmin is None and options.lonmin is None and \
-                    options.latmax is None and options.lonmax is None and \
-                    options.lat is None or options.lon is None and \
-                    options.location is None:
-                geom = 'geojson'
-            else:
-                print("Please choose location, coordinates, rectangle, or geojson, but not all")
-                logger.error("Please choose location, coordinates, rectangle, or geojson, but not all")
-                sys.exit(-1)
+    # Define location for searching: tile, geojson, location, point or rectangle
+    # Tile goes first, otherwise exactly one of the others must be provided
+    provided = {'tile': options.tile is not None,
+                'geojson': options.geojson is not None,
+                'location': options.location is not None,
+                'point': options.lat is not None and options.lon is not None,
+                'rectangle': all(getattr(options, k) is not None
+                                 for k in ('latmin', 'lonmin', 'latmax', 'lonmax'))}
+    geoms = [k for k, v in provided.items() if v]
+    if provided['tile']:
+        geom = 'tile'
+    elif len(geoms) == 0:
+        print("Provide at least tile, location, coordinates, rectangle, or geojson")
+        logger.error("Provide at least tile, location, coordinates, rectangle, or geojson")
+        sys.exit(-1)
+    elif len(geoms) > 1:
+        msg = "Please choose one of location, coordinates, rectangle, " \
+              "or geojson, but not {}".format(', '.join(geoms))
+        print(msg)
+        logger.error(msg)
+        sys.exit(-1)
+    else:
+        geom = geoms[0]
 
     # Generate query based on geometric parameters of catalog request
-    if options.tile is not None:
+    if geom == 'tile':
         if options.tile.startswith('T') and len(options.tile) == 6:
             tileid = options.tile[1:6]
         elif len(options.tile) == 5:
@@ -593,7 +878,7 @@ def peps_downloader(options):
             print("Tile name is ill-formatted : 31TCJ or T31TCJ are allowed")
             logger.error("Tile name is ill-formatted : 31TCJ or T31TCJ are allowed")
             sys.exit(-4)
-        query_geom = "tileid={}".format(tileid)
+        query_geom = {'tileid': tileid}
     elif geom == 'geojson':
         with open(options.geojson) as f:
             gj = geojson.load(f)
@@ -605,17 +890,17 @@ def peps_downloader(options):
             latmax = bbox_gj[3]
             lonmin = bbox_gj[0]
             lonmax = bbox_gj[2]
-            query_geom = 'box={lonmin},{latmin},{lonmax},{latmax}'.format(
+            query_geom = {'box': '{lonmin},{latmin},{lonmax},{latmax}'.format(
                 latmin=latmin, latmax=latmax,
-                lonmin=lonmin, lonmax=lonmax)
+                lonmin=lonmin, lonmax=lonmax)}
     elif geom == 'point':
-        query_geom = 'lat={}\&lon={}'.format(options.lat, options.lon)
+        query_geom = {'lat': options.lat, 'lon': options.lon}
     elif geom == 'rectangle':
-        query_geom = 'box={lonmin},{latmin},{lonmax},{latmax}'.format(
+        query_geom = {'box': '{lonmin},{latmin},{lonmax},{latmax}'.format(
             latmin=options.latmin, latmax=options.latmax,
-            lonmin=options.lonmin, lonmax=options.lonmax)
+            lonmin=options.lonmin, lonmax=options.lonmax)}
     elif geom == 'location':
-        query_geom = "q={}".format(options.location)
+        query_geom = {'q': options.location}
 
     # date parameters of catalog request
     if options.start_date is not None:
@@ -625,16 +910,18 @@ def peps_downloader(options):
         else:
             end_date = date.today().isoformat()
 
+    # Parse the dates once
+    start_dt = date.fromisoformat(str(start_date))
+    end_dt = date.fromisoformat(str(end_date))
+
     # special case for Sentinel-2
     if options.collection == 'S2':
-        if datetime.strptime(options.start_date, '%Y-%m-%d').date() >= \
-                datetime.strptime('2016-12-05', '%Y-%m-%d').date():
+        if start_dt >= S2ST_START:
             print("**** Products after '2016-12-05' are stored in Tiled products collection")
             print("**** Please use option -c S2ST")
             logger.warning("Option -c S2ST should be used for sentinel-2 imagery after '2016-12-05'")
             time.sleep(5)
-        elif datetime.strptime(options.end_date, '%Y-%m-%d').date() >= \
-                datetime.strptime('2016-12-05', '%Y-%m-%d').date():
+        elif end_dt >= S2ST_START:
             print("**** Products after '2016-12-05' are stored in Tiled products collection")
             print("**** Please use option -c S2ST to get the products after that date")
             print("**** Products before that date will be downloaded")
@@ -643,14 +930,12 @@ def peps_downloader(options):
             time.sleep(5)
 
     if options.collection == 'S2ST':
-        if datetime.strptime(options.end_date, '%Y-%m-%d').date() < \
-                datetime.strptime('2016-12-05', '%Y-%m-%d').date():
+        if end_dt < S2ST_START:
             print("**** Products before '2016-12-05' are stored in non-tiled products collection")
             print("**** Please use option -c S2")
             logger.warning("Option -c S2 should be used for sentinel-2 imagery before '2016-12-05'")
             time.sleep(5)
-        elif datetime.strptime(options.start_date, '%Y-%m-%d').date() < \
-                datetime.strptime('2016-12-05', '%Y-%m-%d').date():
+        elif start_dt < S2ST_START:
             print("**** Products before '2016-12-05' are stored in non-tiled products collection")
             print("**** Please use option -c S2 to get the products before that date")
             print("**** Products after that date will be downloaded")
@@ -680,7 +965,8 @@ def peps_downloader(options):
     _query_catalog(options, query_geom, start_date, end_date, logger)
 
     # Read catalog
-    prod, download_dict, storage_dict, size_dict = parse_catalog(options, logger)
+    catalog = parse_catalog(options, logger)
+    prod, download_dict, storage_dict, size_dict = catalog
 
     # ====================
     # Download
@@ -693,74 +979,69 @@ def peps_downloader(options):
         if options.write_dir is None:
             options.write_dir = os.getcwd()
 
-        for prod in list(download_dict.keys()):
-            file_exists = os.path.exists("{}/{}.SAFE".format(options.write_dir, prod)) or \
-                          os.path.exists("{}/{}.zip".format(options.write_dir, prod))
+        # One session for staging and downloads, so connections are reused
+        session = _peps_session(email, passwd)
+        existing = _downloaded_products(options.write_dir)
+        for prod in download_dict:
+            file_exists = prod in existing
             if not options.no_download and not file_exists:
                 if storage_dict[prod] == "tape":
-                    tmticks = time.time()
-                    tmpfile = "{}/tmp_{}.tmp".format(options.write_dir, tmticks)
-                    logger.info("Stage tape product: {}".format(prod))
-                    get_product = "curl -o {} -k -u {}:{} https://peps.cnes.fr/resto/" \
-                                  "collections/{}/{}/download" \
-                                  "/?issuerId=peps &>/dev/null" \
-                        .format(tmpfile, email, passwd,
-                                options.collection, download_dict[prod])
-                    os.system(get_product)
-                    if os.path.exists(tmpfile):
-                        os.remove(tmpfile)
-
-        NbProdsToDownload = len(list(download_dict.keys()))
-        logger.info("{}  products to download".format(NbProdsToDownload))
+                    logger.info("Stage tape product: %s", prod)
+                    _stage_product(options, prod, download_dict[prod], session, logger)
+
+        NbProdsToDownload = len(download_dict)
+        logger.info("%s  products to download", NbProdsToDownload)
+        tape_wait = TAPE_WAIT_MIN
         while NbProdsToDownload > 0:
             # redo catalog search to update disk/tape status
             logger.info("Redo catalog search to update disk/tape status.")
-            _query_catalog(options, query_geom, start_date, end_date, logger)
-            prod, download_dict, storage_dict, size_dict = parse_catalog(options, logger)
+            _query_catalog(options, query_geom, start_date, end_date, logger, use_cache=False)
+            catalog = parse_catalog(options, logger)
+            prod, download_dict, storage_dict, size_dict = catalog
 
+            # Sort out products on disk to download and products still on tape
+            # in a single pass, downloads never change the products on tape
             NbProdsToDownload = 0
-            # download all products on disk
-            for prod in list(download_dict.keys()):
-                file_exists = os.path.exists("{}/{}.SAFE".format(options.write_dir, prod)) or \
-                              os.path.exists("{}/{}.zip".format(options.write_dir, prod))
-                if not options.no_download and not file_exists:
+            prods_on_disk = []
+            existing = _downloaded_products(options.write_dir)
+            for prod in download_dict:
+                if prod in existing:
+                    logger.info("%s already exists", prod)
+                elif not options.no_download:
                     if storage_dict[prod] == "disk":
-                        tmticks = time.time()
-                        tmpfile = "{}/tmp_{}.tmp".format(options.write_dir, tmticks)
-                        logger.info("Download of product : {}".format(prod))
-                        get_product = "curl -o {} -k -u {}:{} https://peps.cnes.fr/resto" \
-                                      "/collections/{}/{}/download" \
-                                      "/?issuerId=peps" \
-                            .format(tmpfile, email, passwd,
-                                    options.collection, download_dict[prod])
-                        # print(get_product)
-                        os.system(get_product)
-                        # check binary product, rename tmp file
-                        if not os.path.exists("{}/tmp_{}.tmp".format(options.write_dir, tmticks)):
-                            NbProdsToDownload += 1
-                        else:
-                            check_rename(tmpfile, options, prod, size_dict[prod], logger)
-
-                elif file_exists:
-                    logger.info("{} already exists".format(prod))
-
-            # download all products on tape
-            for prod in list(download_dict.keys()):
-                file_exists = os.path.exists("{}/{}.SAFE".format(options.write_dir, prod)) or \
-                              os.path.exists("{}/{}.zip".format(options.write_dir, prod))
-                if not options.no_download and not file_exists:
-                    if storage_dict[prod] == "tape" or storage_dict[prod] == "staging":
+                        prods_on_disk.append(prod)
+                    elif storage_dict[prod] == "tape" or storage_dict[prod] == "staging":
                         NbProdsToDownload += 1
 
+            # download all products on disk, a few at a time
+            if len(prods_on_disk) > 0:
+                download_executor = FixedThreadPoolExecutor(
+                    size=min(len(prods_on_disk), DOWNLOAD_THREADS))
+                for prod in prods_on_disk:
+                    download_executor.submit(_download_product, options, prod,
+                                             download_dict[prod], size_dict[prod],
+                                             session, logger)
+                download_executor.drain()
+                download_executor.close()
+                download_executor.raise_first()
+                NbProdsToDownload += download_executor.returns.count(False)
+
             if NbProdsToDownload > 0:
-                logger.info("{} remaining products are on tape, let's wait 1 minutes before trying again"
-                            .format(NbProdsToDownload))
-                time.sleep(60)
+                # Poll soon again after products came on disk,
+                # otherwise back off while they are still staging
+                if len(prods_on_disk) > 0:
+                    tape_wait = TAPE_WAIT_MIN
+                logger.info("%s remaining products are on tape, let's wait %s seconds before trying again",
+                            NbProdsToDownload, tape_wait)
+                time.sleep(tape_wait)
+                tape_wait = min(tape_wait * 2, TAPE_WAIT_MAX)
+
+    return catalog
 
 
 def peps_maja_process(start_date, end_date, tile,
                       log_name, email, passwd, logger,
-                      no_download=False, orbit=None):
+                      no_download=False, orbit=None, session=None):
     """The main script to precess image by maja based on tile.
 
     Args:
@@ -773,6 +1054,7 @@ def peps_maja_process(start_date, end_date, tile,
         no_download (bool): True if not download, otherwise False.
         orbit (int): orbit number.
         logger (logging.Logger): logger object to store logs.
+        session (requests.Session): the session to reuse, optional.
     Returns:
         bool: True if success, otherwise False.
     """
@@ -786,38 +1068,67 @@ def peps_maja_process(start_date, end_date, tile,
     # =====================
     # Start Maja processing
     # =====================
-    peps = "http://peps.cnes.fr/resto/wps"
     if orbit is not None:
-        url = "{}?request=execute&service=WPS&version=1.0.0&identifier" \
-              "=FULL_MAJA&datainputs=startDate={};completionDate={};tileid={};" \
-              "relativeOrbitNumber={}&status=true&storeExecuteResponse=true" \
-            .format(peps, start_date, end_date, tile, orbit)
+        orbit_input = ";relativeOrbitNumber={}".format(orbit)
     else:
-        url = "{}?request=execute&service=WPS&version=1.0.0&identifier" \
-              "=FULL_MAJA&datainputs=startDate={};completionDate={};" \
-              "tileid={}&status=true&storeExecuteResponse=true" \
-            .format(peps, start_date, end_date, tile)
+        orbit_input = ""
+    url = MAJA_WPS_URL.format(start=start_date, end=end_date,
+                              tile=tile, orbit=orbit_input)
     logger.info(url)
     if not no_download:
-        req = requests.get(url, auth=(email, passwd))
+        if session is None:
+            session = _peps_session(email, passwd)
+        try:
+            req = session.get(url, timeout=QUERY_TIMEOUT)
+        except requests.RequestException as e:
+            logger.error("Failed to request maja for tile %s: %s", tile, e)
+            return False
+        body = req.content
         with open(log_name, "wb") as f:
-            f.write(req.text.encode('utf-8'))
+            f.write(body)
         if req.status_code == 200:
-            if b"Process FULL_MAJA accepted" in req.text.encode('utf-8'):
-                logger.info("Request OK ! log is in {}".format(log_name))
+            if b"Process FULL_MAJA accepted" in body:
+                logger.info("Request OK ! log is in %s", log_name)
                 return True
             else:
-                logger.info("Something is wrong : please check {} file".format(log_name))
+                logger.info("Something is wrong : please check %s file", log_name)
                 return False
         elif req.status_code == 401:
             logger.info("Unauthorized request, please check the auth file with provided -a option")
             return False
         else:
-            logger.info("Wrong request status {}".format(str(req.status_code)))
+            logger.info("Wrong request status %s", req.status_code)
             return False
 
 
-def peps_maja_downloader(write_dir, email, password, log_name, logger):
+def _download_maja_product(url, write_dir, email, password, logger, session):
+    """Download a product processed by maja, and retry once if it fails.
+
+    Args:
+        url (str): url of the product.
+        write_dir (str): dir to save results.
+        email (str): peps email.
+        password (str): peps password.
+        logger (logging.Logger): logger object to store logs.
+        session (requests.Session): the session to reuse.
+    """
+    L2AName = url.split('/')[-1]
+    logger.info("downloading %s", L2AName)
+    try:
+        with _maja_download_slots:
+            downloadFile(url, "%s/%s" % (write_dir, L2AName), email, password, session)
+    except Exception:
+        # Whatever error, retry within 30s.
+        time.sleep(30)
+        try:
+            with _maja_download_slots:
+                downloadFile(url, "%s/%s" % (write_dir, L2AName), email, password, session)
+        except Exception:
+            # Keep track of failed tiles, so could do that later manually.
+            logger.error('Failed to download %s twice.', url)
+
+
+def peps_maja_downloader(write_dir, email, password, log_name, logger, session=None):
     """The main script to precess image by maja based on tile.
 
     Args:
@@ -826,68 +1137,97 @@ def peps_maja_downloader(write_dir, email, password, log_name, logger):
         password (str): peps password.
         log_name (str): log file name.
         logger (logging.Logger): logger object to store logs.
+        session (requests.Session): the session to reuse, optional.
     Returns:
         bool: True if download, otherwise False.
     """
-    if not (os.path.exists(write_dir)):
-        os.mkdir(write_dir)
+    os.makedirs(write_dir, exist_ok=True)
 
     try:
         with open(log_name) as f:
-            lignes = f.readlines()
             urlStatus = None
-            for ligne in lignes:
+            for ligne in f:
                 if ligne.startswith("<wps:ExecuteResponse"):
                     wpsId = ligne.split("pywps-")[1].split(".xml")[0]
-                    urlStatus = "https://peps.cnes.fr/cgi-bin/mapcache_results/logs/joblog-{}.log".format(wpsId)
+                    urlStatus = MAJA_JOBLOG_URL.format(wpsId)
+                    break
             if urlStatus is None:
-                logger.error("url for production status not found in logName %s" % log_name)
+                logger.error("url for production status not found in logName %s", log_name)
                 sys.exit(-4)
     except IOError:
         logger.error("error with logName file provided as input or as default parameter")
         sys.exit(-3)
 
     statusFileName = log_name.replace('log', 'stat')
-    if not os.path.exists(os.path.dirname(statusFileName)):
-        os.mkdir(os.path.dirname(statusFileName))
-    getURL(urlStatus, statusFileName, email, password, logger)
+    os.makedirs(os.path.dirname(statusFileName), exist_ok=True)
+    if session is None:
+        session = _peps_session(email, password)
+    getURL(urlStatus, statusFileName, email, password, logger, session)
 
     urls = []
     try:
+        url_prefix = MAJA_RESULTS_URL.format(wpsId)
         with open(statusFileName) as f:
-            lignes = f.readlines()
-            for ligne in lignes:
-                if ligne.find("https://peps.cnes.fr/cgi-bin/mapcache_results/maja/{}".format(wpsId)) >= 0:
-                    url = re.search('https:(.+).zip', ligne).group(0)
+            for ligne in f:
+                if url_prefix in ligne:
+                    url = RE_ZIP_URL.search(ligne).group(0)
                     urls.append(url)
     except IOError:
         logger.error("Rrror with status url found in logName")
         sys.exit(-3)
 
     if len(urls) > 0:
+        existing = _list_products(write_dir)
+        to_download = []
         for url in urls:
             L2AName = url.split('/')[-1]
             if L2AName.find('NOVALD') >= 0:
-                logger.info("%s was too cloudy" % L2AName)
-            elif os.path.isfile(os.path.join(write_dir, L2AName)):
-                logger.info("Skipping {}: already on disk".format(L2AName))
+                logger.info("%s was too cloudy", L2AName)
+            elif L2AName in existing:
+                logger.info("Skipping %s: already on disk", L2AName)
             else:
-                logger.info("downloading %s" % L2AName)
-                try:
-                    downloadFile(url, "%s/%s" % (write_dir, L2AName), email, password)
-                except:
-                    # Whatever error, retry within 30s.
-                    time.sleep(30)
-                    try:
-                        downloadFile(url, "%s/%s" % (write_dir, L2AName), email, password)
-                    except:
-                        # Keep track of failed tiles, so could do that later manually.
-                        logger.error('Failed to download {} twice.'.format(url))
+                to_download.append(url)
+
+        # Download the products of the tile a few at a time
+        if len(to_download) > 0:
+            download_executor = FixedThreadPoolExecutor(
+                size=min(len(to_download), DOWNLOAD_THREADS))
+            for url in to_download:
+                download_executor.submit(_download_maja_product, url, write_dir,
+                                         email, password, logger, session)
+            download_executor.drain()
+            download_executor.close()
+            download_executor.raise_first()
         return True
     else:
         return False
 
 
+def _wait_maja_download(write_dir, email, password, log_name, tile, logger, session):
+    """Poll maja until the products of a tile are ready and downloaded.
+
+    Args:
+        write_dir (str): dir to save results.
+        email (str): peps email.
+        password (str): peps password.
+        log_name (str): log file name.
+        tile (str): tile name.
+        logger (logging.Logger): logger object to store logs.
+        session (requests.Session): the session to reuse.
+    """
+    wait = MAJA_WAIT_MIN
+    try:
+        while not peps_maja_downloader(write_dir, email, password,
+                                       log_name, logger, session):
+            time.sleep(wait)
+            wait = min(wait * 2, MAJA_WAIT_MAX)
+    except SystemExit:
+        # Raise an error instead, so it gets out of the worker thread
+        raise RuntimeError("Failed to download maja products of tile {}, "
+                           "please check {}.".format(tile, log_name))
+    logger.info('full_maja_process: download imagery of tile %s success.', tile)
+
+
 def s2_maja_process(options, stage=False):
     """Run maja installed on peps server
     to process sentinel-2 imagery
@@ -910,12 +1250,7 @@ def s2_maja_process(options, stage=False):
                     datetime.now().strftime("%d%m%Y_%H%M"))
 
     # Set up logger
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-    log_format = "%(asctime)s::%(levelname)s::%(name)s::%(filename)s::%(lineno)d::%(message)s"
-    logging.basicConfig(filename=log, filemode='w',
-                        level=logging.INFO, format=log_format)
-    logger = logging.getLogger(__name__)
+    logger = _setup_logging(log, __name__)
 
     # Check destination path
     if options.dst_dir is None:
@@ -940,10 +1275,10 @@ def s2_maja_process(options, stage=False):
         if options.end_date is not None:
             end_date = options.end_date
         else:
-            end_date = datetime.date.today().isoformat()
-    sdate = datetime.strptime(start_date, '%Y-%m-%d')
-    edate = datetime.strptime(end_date, '%Y-%m-%d')
-    if edate < datetime.strptime('2016-04-01', '%Y-%m-%d'):
+            end_date = date.today().isoformat()
+    sdate = date.fromisoformat(str(start_date))
+    edate = date.fromisoformat(str(end_date))
+    if edate < MAJA_START:
         logger.error("full_maja_process: Because of missing information on ESA L1C products, "
                      "start_date must be greater than '2016-04-01'")
         sys.exit("Error with end date.")
@@ -958,72 +1293,84 @@ def s2_maja_process(options, stage=False):
                      "processing is limited to a one year period per command line")
         sys.exit("Time interval is too large.")
 
+    # All requests share the connections of one session
+    session = _peps_session(email, passwd)
+
     # Stage images to disk and get catalog
     no_download_val = options.no_download
     options.no_download = True
     if stage:
+        tape_wait = TAPE_WAIT_MIN
         while True:
             logger.info("full_maja_process: Stage imagery.")
-            peps_downloader(options)
-            prod, download_dict, storage_dict, size_dict = parse_catalog(options, logger)
+            prod, download_dict, storage_dict, size_dict = peps_downloader(options)
             # Check
-            if list(set(storage_dict.values())) == ['disk']:
+            if all(storage == "disk" for storage in storage_dict.values()):
                 logger.info("full_maja_process: All images are on disk.")
                 break
 
             # Stage
-            for prod in list(download_dict.keys()):
+            for prod in download_dict:
                 if storage_dict[prod] == "tape":
-                    tmticks = time.time()
-                    tmpfile = "{}/tmp_{}.tmp".format(options.write_dir, tmticks)
-                    logger.info("full_maja_process: Stage tape product: {}".format(prod))
-                    get_product = "curl -o {} -k -u {}:{} https://peps.cnes.fr/resto/" \
-                                  "collections/{}/{}/download" \
-                                  "/?issuerId=peps &>/dev/null" \
-                        .format(tmpfile, email, passwd,
-                                options.collection, download_dict[prod])
-                    os.system(get_product)
-                    if os.path.exists(tmpfile):
-                        os.remove(tmpfile)
+                    logger.info("full_maja_process: Stage tape product: %s", prod)
+                    _stage_product(options, prod, download_dict[prod], session, logger)
+
+            # Back off while products are still staging
+            logger.info("full_maja_process: wait %s seconds before checking the staging again.",
+                        tape_wait)
+            time.sleep(tape_wait)
+            tape_wait = min(tape_wait * 2, TAPE_WAIT_MAX)
     else:
         logger.info("full_maja_process: No stage imagery.")
-        peps_downloader(options)
+        prod, download_dict, storage_dict, size_dict = peps_downloader(options)
     options.no_download = no_download_val
-    prod, download_dict, storage_dict, size_dict = parse_catalog(options, logger)
-    prod = list(set(download_dict.keys()))
-    tiles_dup = list(map(lambda x: re.search("T[0-9]{2}[A-Z]{3}", x).group(0), prod))
-    tiles = list(set(map(lambda x: re.search("T[0-9]{2}[A-Z]{3}", x).group(0), prod)))
-    tiles.sort()
+    prod = list(download_dict)
+    # The number of products of each tile
+    tile_counts = Counter(RE_PROD_TILE.search(x).group(0) for x in prod)
+    tiles = sorted(tile_counts)
     tiles = list(_divide_chunks(tiles, 10))
 
     # Request maja
     # Create path for logs
-    if not os.path.isdir(join(options.dst_dir, options.maja_log)):
-        os.mkdir(join(options.dst_dir, options.maja_log))
+    os.makedirs(join(options.dst_dir, options.maja_log), exist_ok=True)
 
     for each in tiles:
-        tiles_done = []
-        wait_lens = []
+        # Submit the maja requests of all tiles in the chunk at the same time
+        request_executor = FixedThreadPoolExecutor(size=len(each))
         for tile in each:
             # Set logName for maja
             log_name = join(options.dst_dir, options.maja_log, '{}.log'.format(tile))
-            if peps_maja_process(start_date, end_date, tile,
-                                 log_name, email, passwd,
-                                 logger=logger, no_download=options.no_download):
+            request_executor.submit(peps_maja_process, start_date, end_date, tile,
+                                    log_name, email, passwd,
+                                    logger=logger, no_download=options.no_download,
+                                    session=session)
+        request_executor.drain()
+        request_executor.close()
+        request_executor.raise_first()
+
+        tiles_done = []
+        wait_lens = []
+        for tile, success in zip(each, request_executor.returns):
+            if success:
                 tiles_done.append(tile)
-                wait_lens.append(60 + 25 * (tiles_dup.count(tile) - 1))
-                logger.info('full_maja_process: query maja for tile {} success.'.format(tile))
+                wait_lens.append(60 + 25 * (tile_counts[tile] - 1))
+                logger.info('full_maja_process: query maja for tile %s success.', tile)
             else:
-                logger.error('full_maja_process: query maja for tile {} fails.'.format(tile))
-        time.sleep(max(wait_lens))
-
-        # Download finished images
-        for tile in tiles_done:
-            log_name = join(options.dst_dir, options.maja_log, '{}.log'.format(tile))
-            while True:
-                if peps_maja_downloader(options.processed_dir, email, passwd, log_name, logger):
-                    logger.info('full_maja_process: download imagery of tile {} success.'.format(tile))
-                    break
+                logger.error('full_maja_process: query maja for tile %s fails.', tile)
+        if len(wait_lens) > 0:
+            time.sleep(max(wait_lens))
+
+        # Download finished images, waiting for all tiles at the same time,
+        # the downloads of all tiles share DOWNLOAD_THREADS slots
+        if len(tiles_done) > 0:
+            download_executor = FixedThreadPoolExecutor(size=len(tiles_done))
+            for tile in tiles_done:
+                log_name = join(options.dst_dir, options.maja_log, '{}.log'.format(tile))
+                download_executor.submit(_wait_maja_download, options.processed_dir,
+                                         email, passwd, log_name, tile, logger, session)
+            download_executor.drain()
+            download_executor.close()
+            download_executor.raise_first()
 
     print('Request finish. Please check {} for details.'.format(log))
 
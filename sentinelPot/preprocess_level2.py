@@ -5,17 +5,93 @@ Author: Lei Song
 Maintainer: Lei Song (lsong@clarku.edu)
 """
 import sys
-import logging
-import shutil
 import time
 import multiprocessing as mp
+from collections import OrderedDict
 from datetime import datetime
+from operator import itemgetter
 from os.path import exists
 from .sentinel_client import *
 from .fixed_thread_pool_executor import FixedThreadPoolExecutor
-from .internal_functions import _run_cmd, _unzip_file, _load_yaml
+from .internal_functions import _run_cmd, _unzip_file, _load_yaml, _rmtree, \
+    _setup_logging, _json_dumps, _read_footprint
 from .peps import ParserConfig, s2_maja_process, peps_downloader
 
+# The fixed parameters of the sentinel-1 GPT graph
+GPT_S1_PARAMS = ["-Presolution=10", "-Porigin=5",
+                 "-Pfilter=Refined Lee", "-Pdem=SRTM 3Sec",
+                 '-Pcrs=GEOGCS["WGS84(DD)", DATUM["WGS84",'
+                 ' SPHEROID["WGS84", 6378137.0, 298.257223563]],'
+                 ' PRIMEM["Greenwich", 0.0], UNIT["degree", 0.017453292519943295],'
+                 ' AXIS["Geodetic longitude", EAST], AXIS["Geodetic latitude", NORTH]]']
+
+
+def _make_dirs(config):
+    """Get the working folders from configs, and create them if necessary.
+
+    Args:
+        config (dict): the dictionary of configs.
+
+    Returns:
+        tuple: the paths of log_dir, catalogs_dir, download_path and processed_path.
+    """
+    dst_dir = config['dirs']['dst_dir']
+    dirs = (join(dst_dir, config['dirs']['log_dir']),
+            join(dst_dir, 'catalogs'),
+            join(dst_dir, config['dirs']['download_path']),
+            join(dst_dir, config['dirs']['processed_path']))
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    return dirs
+
+
+def _start_run(config, prefix):
+    """Create the working folders and the logger of a run.
+    The log file is named with the prefix and a suffix %d%m%Y_%H%M.
+
+    Args:
+        config (dict): the dictionary of configs.
+        prefix (str): the prefix of the log file.
+
+    Returns:
+        tuple: the working folders from `_make_dirs`, the path of log file and the logger.
+    """
+    dirs = _make_dirs(config)
+    log_path = join(dirs[0], '{}_{}.log'.format(
+        prefix, datetime.now().strftime("%d%m%Y_%H%M")))
+    return dirs, log_path, _setup_logging(log_path, __name__)
+
+
+def _cloud_cover(properties):
+    """Get the cloud cover of a footprint.
+    It reads catalogs from both sci-hub and peps.
+
+    Args:
+        properties (dict): the properties of the footprint.
+
+    Returns:
+        float: the cloud cover percentage, None if unknown.
+    """
+    for key in ('cloudcoverpercentage', 'cloudCover'):
+        if properties.get(key) is not None:
+            return float(properties[key])
+    return None
+
+
+def _get_threads_number(config):
+    """Get the number of threads to use from configs.
+
+    Args:
+        config (dict): the dictionary of configs.
+
+    Returns:
+        int: the number of threads.
+    """
+    threads_number = config['parallel']['threads_number']
+    if threads_number == 'default':
+        return mp.cpu_count()
+    return int(threads_number)
+
 
 def scihub_downloader(config):
     """Download sentinel imagery from sci-hub.
@@ -23,19 +99,8 @@ def scihub_downloader(config):
     Args:
         config (dict): the dictionary of configs.
     """
-    # Set up logger
-    dst_dir = config['dirs']['dst_dir']
-    log_dir = join(dst_dir, config['dirs']['log_dir'])
-    if not exists(log_dir):
-        os.makedirs(log_dir)
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-    log_path = join(log_dir, 'sentinel_downloader_{}.log'
-                    .format(datetime.now().strftime("%d%m%Y_%H%M")))
-    log_format = "%(asctime)s::%(levelname)s::%(name)s::%(filename)s::%(lineno)d::%(message)s"
-    logging.basicConfig(filename=log_path, filemode='w',
-                        level=logging.INFO, format=log_format)
-    logger = logging.getLogger(__name__)
+    # Set up folders and logger
+    _, log_path, logger = _start_run(config, 'sentinel_downloader')
 
     # Download
     if config['sentinel']['platformname'] in ['S1', 'S2']:
@@ -56,50 +121,27 @@ def scihub_downloader(config):
         while True:
             # Filter the finished scenes
             logger.info("Sentinel_downloader: filter finished ones.")
-            scenes_finished = sc.get_finished_titles()
-            scene_ids = []
-            for key, item in scenes.items():
-                if item['title'] not in scenes_finished:
-                    scene_ids.append(key)
-            logger.info("Sentinel_downloader: loop {}-there are {} scenes left".format(n_loop, len(scene_ids)))
+            scenes_finished = set(sc.get_finished_titles())
+            scenes_left = OrderedDict((key, item) for key, item in scenes.items()
+                                      if item['title'] not in scenes_finished)
+            logger.info("Sentinel_downloader: loop {}-there are {} scenes left".format(n_loop, len(scenes_left)))
 
             # Check left scenes
-            if len(scene_ids) == 0:
+            if len(scenes_left) == 0:
                 logger.info("Sentinel_downloader: finish downloading all scenes.")
                 break
 
-            # start a new loop to download
-            online_count = 0
-            offline_count = 0
-            trigger_count = 0
-            for scene_id in scene_ids:
-                product_info = sc.api.get_product_odata(scene_id)
-                if product_info['Online']:
-                    online_count = online_count + 1
-                    sc.download_one(scene_id)
-                else:
-                    offline_count = offline_count + 1
-                    while True:
-                        with sc.api.session.get(product_info["url"],
-                                                auth=sc.api.session.auth,
-                                                timeout=sc.api.timeout) as r:
-                            status = r.status_code
-                            if status == 202:
-                                sc.download_one(scene_id)
-                                trigger_count = trigger_count + 1
-                                break
-                            if status == 403:
-                                time.sleep(600)
-                logger.info("Sentinel_downloader: loop {}, {} out of {} are processed."
-                            .format(n_loop, online_count + offline_count, len(scene_ids)))
-                logger.info("Sentinel_downloader: loop {}, {} imagery are triggered."
-                            .format(n_loop, trigger_count))
-            logger.info("Sentinel_downloader: loop {}, there are {} online imagery, "
-                        "and {} are triggered from {} offline imagery."
-                        .format(n_loop, online_count, trigger_count, offline_count))
+            # Download online imagery and trigger offline imagery at the same time,
+            # then download the offline imagery once it comes online.
+            # The scenes which fail are tried again in the next loop.
+            downloaded = sc.download_all_scihub(scenes_left, logger=logger)
+            logger.info("Sentinel_downloader: loop {}, {} out of {} scenes are downloaded."
+                        .format(n_loop, len(downloaded), len(scenes_left)))
             logger.info("Sentinel_downloader: Finished loop {}.".format(n_loop))
             n_loop = n_loop + 1
-            time.sleep(7200)
+            # Do not retry failed scenes straight away
+            if len(downloaded) == 0:
+                time.sleep(LTA_POLL_INTERVAL)
     else:
         logger.error("Sentinel_downloader: not support platform, [S1, S2].")
     print('s_download is done, please check {} for logs.'.format(log_path))
@@ -108,7 +150,7 @@ def scihub_downloader(config):
 def s1_gpt_process(fname, gpt_path,
                    download_path, processed_path,
                    xml_path='./files/S1_GRD_preprocessing.xml',
-                   logger=None):
+                   logger=None, threads_per_job=None):
     """Preprocess sentinel using gpt
 
     Args:
@@ -118,6 +160,7 @@ def s1_gpt_process(fname, gpt_path,
         gpt_path (str): the path of gpt, should be `{snap_dir}/etc/bin/gpt`.
         xml_path (str): path of xml file.
         logger (logging.Logger): the logger object to store logs.
+        threads_per_job (int): the number of threads of gpt, None to use all cores.
     """
     fname_safe = fname.replace("zip", "SAFE")
     fname_out = fname.replace("zip", "dim")
@@ -126,22 +169,20 @@ def s1_gpt_process(fname, gpt_path,
 
     # Run cmd
     if not exists(fname_output):
-        # Unzip
-        if not exists(fname_input):
-            _unzip_file(fname, download_path)
-
-        cmd = f"{gpt_path} {xml_path} -Presolution=10 -Porigin=5" + \
-              f" -Pfilter='Refined Lee' -Pdem='SRTM 3Sec'" + \
-              f" -Pcrs='GEOGCS[\"WGS84(DD)\", DATUM[\"WGS84\"," + \
-              f" SPHEROID[\"WGS84\", 6378137.0, 298.257223563]]," + \
-              f" PRIMEM[\"Greenwich\", 0.0], UNIT[\"degree\", 0.017453292519943295]," + \
-              f" AXIS[\"Geodetic longitude\", EAST], AXIS[\"Geodetic latitude\", NORTH]]'" + \
-              f" -Pinput={fname_input} -Poutput={fname_output}"
+        # GPT reads the zip file directly, so no need to unzip it
+        unzipped = exists(fname_input)
+        if not unzipped:
+            fname_input = f"{download_path}/{fname}"
+
+        cmd = [gpt_path, xml_path] + GPT_S1_PARAMS + \
+              [f"-Pinput={fname_input}", f"-Poutput={fname_output}"]
+        if threads_per_job is not None:
+            cmd += ["-q", str(threads_per_job)]
         _run_cmd(cmd, logger)
 
         # Remove unzipped file
-        if exists(fname_input):
-            shutil.rmtree(fname_input)
+        if unzipped:
+            _rmtree(fname_input, logger)
         logger.info("s1_gpt_process: preprocess done, saved as {}.".format(fname_output))
     else:
         logger.info("s1_gpt_process: {} already exists.".format(fname_output))
@@ -158,27 +199,10 @@ def s1_preprocess(config_path, query=False, source='peps', parallel=False):
         parallel (bool): option to process in parallel.
     """
     config = _load_yaml(config_path)
-    # Set destination directory for working
+    # Set destination directory for working and logger
     # Create folders if necessary
-    dst_dir = config['dirs']['dst_dir']
-    log_dir = join(dst_dir, config['dirs']['log_dir'])
-    catalogs_dir = join(dst_dir, 'catalogs')
-    download_path = join(dst_dir, config['dirs']['download_path'])
-    processed_path = join(dst_dir, config['dirs']['processed_path'])
-    for d in [log_dir, catalogs_dir, download_path, processed_path]:
-        if not exists(d):
-            os.makedirs(d)
-
-    # Set up logger
-    # The log file with suffix %d%m%Y_%H%M
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-    log_path = join(log_dir, 'sentinel1_preprocess_{}.log'
-                    .format(datetime.now().strftime("%d%m%Y_%H%M")))
-    log_format = "%(asctime)s::%(levelname)s::%(name)s::%(filename)s::%(lineno)d::%(message)s"
-    logging.basicConfig(filename=log_path, filemode='w',
-                        level=logging.INFO, format=log_format)
-    logger = logging.getLogger(__name__)
+    (_, catalogs_dir, download_path, processed_path), log_path, logger = \
+        _start_run(config, 'sentinel1_preprocess')
 
     # Start pre-processing
     logger.info("Sentinel1_preprocess: start pre-processing sentinel-1 images.")
@@ -209,21 +233,25 @@ def s1_preprocess(config_path, query=False, source='peps', parallel=False):
     if not exists(xml_path):
         logger.error("Sentinel1_preprocess: xml file {} not found.".format(xml_path))
         sys.exit("Sentinel1_preprocess: xml file {} not found.".format(xml_path))
+    threads_per_job = config['gpt'].get('threads_per_job')
+    if threads_per_job is not None:
+        threads_per_job = int(threads_per_job)
     logger.info("Sentinel1_preprocess: gpt is set to use {}.".format(gpt_path))
     logger.info("Sentinel1_preprocess: xml is set to use {}.".format(xml_path))
 
     # Get files
-    fnames = os.listdir(download_path)
-    fnames = list(filter(lambda fn: ".zip" in fn, fnames))
+    with os.scandir(download_path) as entries:
+        fnames = [entry.name for entry in entries
+                  if entry.name.endswith('.zip') and entry.is_file()]
 
     if parallel:
         # Process with fixed threads
         # determine thread number to be used
-        threads_number = config['parallel']['threads_number']
-        if threads_number == 'default':
-            threads_number = mp.cpu_count()
-        else:
-            threads_number = int(threads_number)
+        threads_number = _get_threads_number(config)
+        # Each gpt job runs threads of its own, so run fewer jobs
+        # at the same time to leave one core for each thread
+        if threads_per_job is not None:
+            threads_number = max(1, threads_number // threads_per_job)
         logger.info("Sentinel1_preprocess: set number of threads to {}.".format(threads_number))
 
         success_count = 0
@@ -232,7 +260,7 @@ def s1_preprocess(config_path, query=False, source='peps', parallel=False):
         for fname in fnames:
             if s1_process_executor.submit(s1_gpt_process, fname, gpt_path,
                                           download_path, processed_path,
-                                          xml_path, logger) is True:
+                                          xml_path, logger, threads_per_job) is True:
                 success_count += 1
             else:
                 failure_count += 1
@@ -249,7 +277,8 @@ def s1_preprocess(config_path, query=False, source='peps', parallel=False):
         failure_count = 0
         for fname in fnames:
             if s1_gpt_process(fname, gpt_path, download_path,
-                              processed_path, xml_path, logger) is True:
+                              processed_path, xml_path, logger,
+                              threads_per_job) is True:
                 success_count += 1
             else:
                 failure_count += 1
@@ -260,7 +289,8 @@ def s1_preprocess(config_path, query=False, source='peps', parallel=False):
 
 
 def s2_atmospheric_correction(fname, processed_path='./sen2cor',
-                              sen2cor_path=None, logger=None):
+                              sen2cor_path=None, logger=None,
+                              resolution=None):
     """Do atmospheric correction using sen2cor for sentinel2 imagery
 
     Args:
@@ -268,6 +298,11 @@ def s2_atmospheric_correction(fname, processed_path='./sen2cor',
         processed_path (str): the directory for results.
         sen2cor_path (str): the path of sen2cor.
         logger (logging.Logger): the logging object to store logs.
+        resolution (int): the target resolution, 10, 20 or 60.
+            None to process both 20m and 10m as sen2cor does by default.
+
+    Returns:
+        bool: True if success, otherwise False
     """
 
     # Run sen2cor
@@ -277,17 +312,24 @@ def s2_atmospheric_correction(fname, processed_path='./sen2cor',
     else:
         if not exists(processed_path):
             os.mkdir(processed_path)
-        cmd = '{} --output_dir {} {}'.format(sen2cor_path, processed_path, fname)
-        _run_cmd(cmd, logger)
+        cmd = [sen2cor_path, '--output_dir', processed_path, fname]
+        if resolution is not None:
+            cmd += ['--resolution', str(resolution)]
+        return _run_cmd(cmd, logger)
 
 
-def s2_fmask(tile_name, config, logger):
+def s2_fmask(tile_name, config, logger, check_docker=True):
     """Do cloud and shadow detection using fmask for sentinel2 imagery
 
     Args:
         tile_name (str): the name of sentinel-2 tile.
         logger (logging.Logger): the logger object to store logs.
         config (dict): the dictionary of parameters for fmask.
+        check_docker (bool): option to check the fmask docker image first.
+            Set it to False if it is already checked for a batch of tiles.
+
+    Returns:
+        bool: True if success, otherwise False
     """
     # Set paths
     download_path = join(config['dirs']['dst_dir'],
@@ -307,28 +349,28 @@ def s2_fmask(tile_name, config, logger):
     # Format tile_id
     tile_id = tile_name.split("_")[5]
     tile_dt = tile_name.split("_")[2]
-    fnames_all = os.listdir(processed_path)
     # Because of a bug in output folder name of sen2cor
-    safe_path = list(filter(lambda fname: tile_id in fname and tile_dt in fname, fnames_all))
+    with os.scandir(processed_path) as entries:
+        safe_path = [entry.name for entry in entries
+                     if tile_id in entry.name and tile_dt in entry.name]
     if len(safe_path) == 1:
         dst_path = join(processed_path, safe_path[0], "GRANULE")
-        img_path = list(filter(lambda fname: "L2A" in fname, os.listdir(dst_path)))
-        mv_path = join(dst_path, img_path[0], "FMASK_DATA/")
+        with os.scandir(dst_path) as entries:
+            img_name = next(entry.name for entry in entries if "L2A" in entry.name)
+        mv_path = join(dst_path, img_name, "FMASK_DATA/")
         os.makedirs(mv_path)
-        src_path = join(dst_path, img_path[0].replace("L2A", "L1C"), "*.tif")
-        del_path = join(dst_path, img_path[0].replace("L2A", "L1C"))
+        src_path = join(dst_path, img_name.replace("L2A", "L1C"), "*.tif")
+        del_path = join(dst_path, img_name.replace("L2A", "L1C"))
     else:
         if logger is None:
-            print("There is no atmospheric corrected tile for ", tile_name)
+            print("There is no atmospheric corrected tile for {}".format(tile_name))
         else:
-            logger.warning("There is no atmospheric corrected tile for ", tile_name)
-        exit("There is no atmospheric corrected tile for ", tile_name)
+            logger.warning("There is no atmospheric corrected tile for {}".format(tile_name))
+        return False
 
     if docker:
         # Check docker
-        cmd = 'docker image ls | grep "fmask"'
-        if not _run_cmd(cmd, logger):
-            logger.error('There is no docker image fmask running. Please use fmask_docker_install to install.')
+        if check_docker and not _check_fmask_docker(logger):
             exit('There is no docker image fmask running. Please use fmask_docker_install to install.')
         # Run Fmask
         # get parameters
@@ -345,7 +387,7 @@ def s2_fmask(tile_name, config, logger):
                                                     src_path, mv_path)
         if _run_cmd(cmd, logger):
             if exists(del_path):
-                shutil.rmtree(del_path)
+                _rmtree(del_path, logger)
             return True
         else:
             return False
@@ -371,20 +413,42 @@ def s2_fmask(tile_name, config, logger):
                                                          src_path, mv_path)
         if _run_cmd(cmd, logger):
             if exists(del_path):
-                shutil.rmtree(del_path)
+                _rmtree(del_path, logger)
             return True
         else:
             return False
 
 
-def s2_preprocess_each(tile_name, config, logger):
+def _check_fmask_docker(logger):
+    """Check if the docker image of fmask is installed.
+
+    Args:
+        logger (logging.Logger): the logger object to store logs.
+
+    Returns:
+        bool: True if the image exists, otherwise False
+    """
+    cmd = 'docker image ls | grep "fmask"'
+    if _run_cmd(cmd, logger):
+        return True
+    logger.error('There is no docker image fmask running. Please use fmask_docker_install to install.')
+    return False
+
+
+def s2_preprocess_each(tile_name, config, logger, check_docker=True):
     """Preprocess for sentinel2 imagery
     This function use sen2cor and fmask together.
+    A failed tile is logged and reported by the return value,
+    so one bad tile does not stop the worker that runs it.
 
     Args:
         tile_name (str): the name of sentinel-2 tile.
         config (dict): config dictionary.
         logger (logging.Logger): the logger object to store logs.
+        check_docker (bool): option to check the fmask docker image first.
+
+    Returns:
+        bool: True if success, otherwise False
     """
     # File name
     download_path = join(config['dirs']['dst_dir'],
@@ -398,27 +462,30 @@ def s2_preprocess_each(tile_name, config, logger):
             _unzip_file(fname_zip, download_path)
         else:
             logger.error("s2_preprocess_each: No zip or SAFE file found for {}.".format(tile_name))
-            exit("s2_preprocess_each: No zip or SAFE file found for {}.".format(tile_name))
+            return False
 
     # sen2cor
     # Set paths
     processed_path = join(config['dirs']['dst_dir'],
                           config['dirs']['processed_path'])
     sen2cor_path = config['sen2cor']['sen2cor_path']
-    if not s2_atmospheric_correction(fname, processed_path, sen2cor_path, logger):
+    resolution = config['sen2cor'].get('resolution')
+    if not s2_atmospheric_correction(fname, processed_path, sen2cor_path,
+                                     logger, resolution):
         logger.error("s2_preprocess_each: Atmospheric correction for tile {} failed.".format(tile_name))
-        exit("s2_preprocess_each: Atmospheric correction for tile {} failed.".format(tile_name))
+        return False
     logger.info("s2_preprocess_each: Atmospheric correction for tile {} done.".format(tile_name))
 
     # Fmask
-    if not s2_fmask(tile_name, config, logger):
+    if not s2_fmask(tile_name, config, logger, check_docker):
         logger.error("s2_preprocess_each: Fmask for tile {} failed.".format(tile_name))
-        exit("s2_preprocess_each: Fmask for tile {} failed.".format(tile_name))
+        return False
     logger.info("s2_preprocess_each: Fmask calculation for tile {} done.".format(tile_name))
 
     # Remove unzipped files
     if not keep:
-        shutil.rmtree(fname)
+        _rmtree(fname, logger)
+    return True
 
 
 def s2_preprocess(config_path, option='regular', query=False, source='peps'):
@@ -434,27 +501,10 @@ def s2_preprocess(config_path, option='regular', query=False, source='peps'):
     """
 
     config = _load_yaml(config_path)
-    # Set destination directory for working
+    # Set destination directory for working and logger
     # Create folders if necessary
-    dst_dir = config['dirs']['dst_dir']
-    log_dir = join(dst_dir, config['dirs']['log_dir'])
-    catalogs_dir = join(dst_dir, 'catalogs')
-    download_path = join(dst_dir, config['dirs']['download_path'])
-    processed_path = join(dst_dir, config['dirs']['processed_path'])
-    for d in [log_dir, catalogs_dir, download_path, processed_path]:
-        if not exists(d):
-            os.makedirs(d)
-
-    # Set up logger
-    # The log file with suffix %d%m%Y_%H%M
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-    log_path = join(log_dir, 'sentinel2_preprocess_{}.log'
-                    .format(datetime.now().strftime("%d%m%Y_%H%M")))
-    log_format = "%(asctime)s::%(levelname)s::%(name)s::%(filename)s::%(lineno)d::%(message)s"
-    logging.basicConfig(filename=log_path, filemode='w',
-                        level=logging.INFO, format=log_format)
-    logger = logging.getLogger(__name__)
+    (_, catalogs_dir, download_path, processed_path), log_path, logger = \
+        _start_run(config, 'sentinel2_preprocess')
 
     # preprocess imagery
     if option == 'regular':
@@ -476,44 +526,60 @@ def s2_preprocess(config_path, option='regular', query=False, source='peps'):
         sc = SentinelClient(config)
         # Filter the finished scenes
         if os.path.isfile(sc.footprint_list):
-            s2_footprints = read_geojson(sc.footprint_list)
+            s2_footprints = _read_footprint(sc.footprint_list, catalogs_dir)
         else:
             s2_footprints = sc.make_footprints()
         logger.info('Sentinel2_preprocess: get footprints.')
 
-        # Get tiles to process
-        tile_names = []
-        for feature in s2_footprints['features']:
-            title = feature['properties']['title']
-            # title = re.sub("N[0-9]{4}", "N9999", re.sub("L1C", "L2A", title))
-            # title = re.sub("_[0-9]{8}T[0-9]+$", "", title)
-            tile_names.append(title)
-        tile_names = list(set(tile_names))
+        # Get unique tiles to process, in the order of footprints
+        # Skip the cloudy ones, the catalog could be made with a looser limit
+        tile_names = {}
+        skipped = set()
+        for properties in map(itemgetter('properties'), s2_footprints['features']):
+            title = properties['title']
+            if title in tile_names or title in skipped:
+                continue
+            cloud_cover = _cloud_cover(properties)
+            if cloud_cover is not None and cloud_cover > sc.cloudcover:
+                skipped.add(title)
+            else:
+                tile_names[title] = None
+        tile_names = list(tile_names)
         logger.info('Sentinel2_preprocess: get tiles.')
+        logger.info('Sentinel2_preprocess: skip {} tiles with cloud cover over {}.'
+                    .format(len(skipped), sc.cloudcover))
+        try:
+            with open(join(catalogs_dir, 'tile_todo.json'), 'wb') as f:
+                f.write(_json_dumps(tile_names))
+        except OSError:
+            logger.warning('Sentinel2_preprocess: failed to save the tiles to process.')
         logger.info('Sentinel2_preprocess: there are {} tile need to process.'.format(len(tile_names)))
 
         # determine thread number to be used
-        threads_number = config['parallel']['threads_number']
-        if threads_number == 'default':
-            threads_number = mp.cpu_count()
-        else:
-            threads_number = int(threads_number)
+        threads_number = _get_threads_number(config)
         logger.info("Sentinel2_preprocess: set number of threads to {}.".format(threads_number))
 
+        # Check the tools once for all tiles instead of once per tile
+        sen2cor_path = config['sen2cor']['sen2cor_path']
+        if sen2cor_path is None or (not exists(sen2cor_path)):
+            logger.error('sen2cor_path is not set correctly.')
+            sys.exit('sen2cor_path is not set correctly.')
+        if config['fmask']['docker'] and not _check_fmask_docker(logger):
+            sys.exit('There is no docker image fmask running. Please use fmask_docker_install to install.')
+
         # Process with fixed threads
-        success_count = 0
-        failure_count = 0
         s2_preprocess_executor = FixedThreadPoolExecutor(size=threads_number)
         for tile_name in tile_names:
-            if s2_preprocess_executor.submit(s2_preprocess_each, tile_name,
-                                             config, logger) is True:
-                success_count += 1
-            else:
-                failure_count += 1
+            s2_preprocess_executor.submit(s2_preprocess_each, tile_name,
+                                          config, logger, False)
         # await all tile finished
         s2_preprocess_executor.drain()
         # await thread pool to stop
         s2_preprocess_executor.close()
+        for e in s2_preprocess_executor.exceptions:
+            logger.error("Sentinel2_preprocess: {}".format(e))
+        success_count = s2_preprocess_executor.returns.count(True)
+        failure_count = len(tile_names) - success_count
         logger.info("Sentinel2_preprocess: finished s2 preprocess task in regular mode; "
                     "the total tile number to be processed is {}; "
                     "the success_count is {}; the failure_count is {}"
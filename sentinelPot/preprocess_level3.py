@@ -12,6 +12,7 @@ import re
 import shutil
 import sys
 import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from datetime import timedelta
 from os.path import exists
@@ -22,11 +23,31 @@ except ImportError:
     from osgeo import gdal
 import numpy as np
 from rpy2.robjects.packages import STAP
-from sklearn.linear_model import Lasso
 from .fixed_thread_pool_executor import FixedThreadPoolExecutor
 from .guided_filter import guided_filter
-from .internal_functions import _run_cmd, _copytree, _load_yaml, _unzip_file
+from .internal_functions import _run_cmd, _copytree, _load_yaml, _unzip_file, \
+    _setup_logging
 from .sentinel_client import SentinelClient
+try:
+    from .harmonic_numba import fit_harmonic_numba, replace_nodata_numba
+except ImportError:
+    fit_harmonic_numba = None
+    replace_nodata_numba = None
+
+# The most sweeps of coordinate descent of lasso for a pixel
+LASSO_MAX_ITER = 10000
+# The tolerance of duality gap to stop coordinate descent of lasso,
+# the same as the default of sklearn.linear_model.Lasso
+LASSO_TOL = 1e-4
+# The least number of rows of images to fit at a time in harmonic_fitting,
+# it is rounded up to the block height of images
+BLOCK_ROWS = 256
+# The creation options of GeoTiff of harmonic coefficients,
+# tiles of the height of BLOCK_ROWS so each block of rows fills whole tiles
+COEFS_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256',
+                 'COMPRESS=DEFLATE', 'NUM_THREADS=ALL_CPUS']
+# The state of each worker process of harmonic_fitting_br
+_br_worker = {}
 
 
 def guided_filter_batch(tile_index, config, out_format='ENVI', logger=None):
@@ -58,9 +79,9 @@ def guided_filter_batch(tile_index, config, out_format='ENVI', logger=None):
     eps = config['harmonic']['eps']
 
     # Get clipped file names
-    fnames = os.listdir(dir_clip)
-    fnames = list(filter(lambda fname: ".img" in fname and ".aux.xml" not in fname, fnames))
-    fnames = list(map(lambda fname: os.path.join(dir_clip, fname), fnames))
+    with os.scandir(dir_clip) as entries:
+        fnames = [entry.path for entry in entries
+                  if ".img" in entry.name and ".aux.xml" not in entry.name]
 
     # determine thread number to be used
     threads_number = config['parallel']['threads_number']
@@ -73,26 +94,28 @@ def guided_filter_batch(tile_index, config, out_format='ENVI', logger=None):
     # guided_filter_partial = partial(guided_filter, ksize=ksize, eps=eps, dst_dir=dir_ard)
     # pool.map(guided_filter_partial, fnames)
     # pool.close()
+    # Files are filtered in parallel, so use one thread for the tiles of each file
     gf_executor = FixedThreadPoolExecutor(size=threads_number)
     for src_path in fnames:
-        gf_executor.submit(guided_filter, src_path, ksize, eps, dir_ard, out_format)
+        gf_executor.submit(guided_filter, src_path, ksize, eps, dir_ard, out_format, 1)
     gf_executor.drain()
     gf_executor.close()
 
 
-def _get_date(fname):
-    """Get date from a filename.
+def _get_dates(fnames):
+    """Get dates from filenames.
     Wrote and modified with Boka Luo
 
     Args:
-        fname (str): the name of file.
+        fnames (list of str): the list of file names.
 
     Returns:
-        datetime.date: the date.
+        numpy.ndarray of numpy.datetime64: the dates.
     """
-    date = fname.split("_")[4]
-    date = datetime.strptime("-".join([date[0:4], date[4:6], date[6:8]]), '%Y-%m-%d')
-    return date
+    # The date is the first 8 digits of the fifth part, e.g. 20190101T...
+    return np.array(["{}-{}-{}".format(date[0:4], date[4:6], date[6:8])
+                     for date in (fname.split("_")[4] for fname in fnames)],
+                    dtype='datetime64[D]')
 
 
 def _sort_fnames(fnames):
@@ -104,22 +127,22 @@ def _sort_fnames(fnames):
     Returns:
         list of str: a list of sorted fname.
     """
-    dates = list(map(lambda fname: _get_date(fname), fnames))
-    fnames = [fnames[i] for i in np.argsort(dates)]
+    order = np.argsort(_get_dates(fnames), kind='stable')
+    fnames = [fnames[i] for i in order]
     return fnames
 
 
-def _get_date_doy(date):
-    """Get the day of year from a date.
+def _get_date_doy(dates):
+    """Get the day of year from dates.
 
     Args:
-        date (datetime.date): the date.
+        dates (numpy.ndarray of numpy.datetime64): the dates.
 
     Returns:
-        int: day of year.
+        numpy.ndarray: days of year.
     """
-    day_of_year = date.timetuple().tm_yday
-    return day_of_year
+    dates = dates.astype('datetime64[D]')
+    return (dates - dates.astype('datetime64[Y]')).astype(int) + 1
 
 
 def _adjust_doy(doys, start, freq):
@@ -131,10 +154,10 @@ def _adjust_doy(doys, start, freq):
         freq (int): the frequency of the year, e.g. 365.
 
     Returns:
-        list: an array of adjusted DOYs.
+        numpy.ndarray: an array of adjusted DOYs.
     """
-    doys = list(map(lambda doy: doy - start, doys))
-    doys = list(map(lambda doy: doy if doy >= 0 else doy + start + freq - start, doys))
+    doys = doys - start
+    doys[doys < 0] += freq
     return doys
 
 
@@ -150,20 +173,18 @@ def _get_doy(fnames, freq, start):
         numpy.ndarray: an array of DOY.
     """
     # Extract time
-    dates = list(map(lambda fname: _get_date(fname), fnames))
-    dates.sort()
+    dates = np.sort(_get_dates(fnames))
 
     # Get DOY
-    doys = list(map(lambda date: _get_date_doy(date), dates))
+    doys = _get_date_doy(dates)
 
     if start is None:
         start_doy = doys[0]
     else:
-        start_doy = _get_date_doy(datetime.strptime(start, '%Y-%m-%d'))
+        start_doy = _get_date_doy(np.datetime64(start, 'D'))
 
     # Adjust DOY
     doys = _adjust_doy(doys, start_doy, freq)
-    doys = np.array(doys)
     return doys
 
 
@@ -179,56 +200,243 @@ def _getVariable(freq, day_arr, n):
     Returns:
         numpy.ndarray: x variable for harmonic regression.
     """
-    t = np.tile(np.array([day_arr]).transpose(), (1, n))
-    n = np.tile(np.arange(n), (len(day_arr), 1))
+    day_arr = np.asarray(day_arr, dtype=np.float64)
+    n = np.arange(n)
     n0 = np.ceil(n / 2)
 
-    out = np.cos((2 * np.pi * n0 * t) / freq - (n % 2) * np.pi / 2)
-    out[:, 0] = t[:, 0]
+    # Broadcast days in rows against harmonics in cols
+    out = np.cos((2 * np.pi / freq) * n0 * day_arr[:, None] - (n % 2) * (np.pi / 2))
+    out[:, 0] = day_arr
+
+    return out
+
+
+def _read_band(band, xoff, yoff, out):
+    """Read a window of a band into an array, with nodata as nan.
 
+    Args:
+        band (gdal.Band): the band to read.
+        xoff (int): the offset of col.
+        yoff (int): the offset of row.
+        out (numpy.ndarray of numpy.float32): the array to read into,
+            its shape is the size of the window.
+
+    Returns:
+        numpy.ndarray of numpy.float32: out.
+    """
+    novalue = band.GetNoDataValue()
+    band.ReadAsArray(xoff, yoff, out.shape[1], out.shape[0], buf_obj=out)
+    if novalue is None:
+        return out
+    if replace_nodata_numba is not None:
+        # One pass over the image without a temporary mask
+        replace_nodata_numba(out, novalue)
+    else:
+        np.putmask(out, out == np.float32(novalue), np.nan)
     return out
 
 
-def read_rows(fname, offset_row, n_cols):
+def read_rows(fname, offset_row, n_cols, out=None):
     """Read rows of an imagery.
     
     Args:
         fname (str): path of imagery.
         offset_row (int): the offset of row.
         n_cols (int): the col size to read.
+        out (numpy.ndarray of numpy.float32): the array to read into, None to create one.
 
     Returns:
         numpy.ndarray: an array of values of target rows.
     """
+    if out is None:
+        out = np.empty(n_cols, dtype=np.float32)
     img = gdal.Open(fname)
-    band = img.GetRasterBand(1)
-    novalue = np.float32(band.GetNoDataValue())
-    values = band.ReadAsArray(0, offset_row, n_cols, 1)
-    values_out = np.where(values == novalue, np.nan, values)
+    _read_band(img.GetRasterBand(1), 0, offset_row, out.reshape(1, n_cols))
     img = None
-    band = None
 
-    return values_out.flatten()
+    return out
 
 
-def read_img(fname):
+def read_img(fname, out=None):
     """Read a full imagery.
 
     Args:
         fname (str): path of imagery.
+        out (numpy.ndarray of numpy.float32): the array to read into,
+            e.g. a slice of a preallocated cube, None to create one.
 
     Returns:
         numpy.ndarray: an array of values of target rows.
     """
     img = gdal.Open(fname)
-    band = img.GetRasterBand(1)
-    novalue = np.float32(band.GetNoDataValue())
-    values = band.ReadAsArray()
-    values_out = np.where(values == novalue, np.nan, values)
+    if out is None:
+        out = np.empty((img.RasterYSize, img.RasterXSize), dtype=np.float32)
+    _read_band(img.GetRasterBand(1), 0, 0, out)
     img = None
-    band = None
 
-    return values_out
+    return out
+
+
+def _group_by_mask(valid):
+    """Group pixels by the pattern of their valid values.
+
+    Args:
+        valid (numpy.ndarray of bool): the valid values with shape (T, N).
+
+    Returns:
+        list of tuple: the valid dates (numpy.ndarray of bool with shape (T,))
+        and the indices of pixels of each group.
+    """
+    # Pack the patterns into bytes to compare them faster
+    keys = np.packbits(valid, axis=0)
+    if len(keys) <= 8:
+        # Up to 64 dates fit in one integer, which sorts much faster
+        keys = np.pad(keys, ((0, 8 - len(keys)), (0, 0))).T.copy().view(np.uint64).ravel()
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    else:
+        _, first, inverse = np.unique(keys, axis=1, return_index=True,
+                                      return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse))[:-1]
+    return [(valid[:, first[k]], idx)
+            for k, idx in enumerate(np.split(order, bounds))]
+
+
+def _lasso_gram(gram, xy, y_norm2, alpha):
+    """Fit lasso for a batch of targets which share the same variables.
+    It does coordinate descent on all targets at the same time,
+    with the Gram matrix of the centered variables.
+    It stops each target as sklearn.linear_model.Lasso does.
+
+    Args:
+        gram (numpy.ndarray): the Gram matrix of variables with shape (p, p).
+        xy (numpy.ndarray): the product of variables and targets with shape (p, m).
+        y_norm2 (numpy.ndarray): the squared norm of targets with shape (m,).
+        alpha (float): the alpha of lasso, multiplied by the number of samples.
+
+    Returns:
+        numpy.ndarray: the coefficients with shape (p, m).
+    """
+    p, m = xy.shape
+    coefs = np.zeros((p, m))
+    diag = np.diag(gram)
+    tol = LASSO_TOL * y_norm2
+    active = np.arange(m)
+    for _ in range(LASSO_MAX_ITER):
+        w = coefs[:, active]
+        q = xy[:, active]
+        d_w_max = np.zeros(len(active))
+        for j in range(p):
+            if diag[j] == 0:
+                continue
+            w_j = w[j].copy()
+            rho = q[j] - gram[j] @ w + diag[j] * w_j
+            w[j] = np.sign(rho) * np.maximum(np.abs(rho) - alpha, 0) / diag[j]
+            d_w_max = np.maximum(d_w_max, np.abs(w[j] - w_j))
+        coefs[:, active] = w
+
+        # Check the duality gap of targets which hardly change
+        w_max = np.abs(w).max(axis=0)
+        check = (w_max == 0) | (d_w_max <= LASSO_TOL * w_max)
+        if not check.any():
+            continue
+        w, q = w[:, check], q[:, check]
+        h = gram @ w
+        q_dot_w = (w * q).sum(axis=0)
+        dual_norm = np.abs(q - h).max(axis=0)
+        r_norm2 = y_norm2[active[check]] + (w * h).sum(axis=0) - 2 * q_dot_w
+        const = np.where(dual_norm > alpha, alpha / np.maximum(dual_norm, alpha), 1)
+        gap = 0.5 * r_norm2 * (1 + const ** 2)
+        gap = np.where(dual_norm > alpha, gap, r_norm2)
+        gap += alpha * np.abs(w).sum(axis=0) - const * y_norm2[active[check]] + const * q_dot_w
+        done = np.zeros(len(active), dtype=bool)
+        done[check] = gap <= tol[active[check]]
+        active = active[~done]
+        if len(active) == 0:
+            break
+    return coefs
+
+
+def _fit_harmonic(values, x, alpha):
+    """Fit lasso of harmonic regression for all pixels.
+    It uses the numba kernels if numba is installed.
+    Otherwise, pixels with the same valid dates share the same variables,
+    so each group of them is fitted together.
+    Lasso with alpha 0 is least squares, so each group is solved by one lstsq.
+
+    Args:
+        values (numpy.ndarray): the values of pixels with shape (T, N), nan for nodata.
+        x (numpy.ndarray): x variable for harmonic regression with shape (T, p).
+        alpha (float): the alpha of lasso.
+
+    Returns:
+        numpy.ndarray of numpy.float32: the intercept and coefficients with shape (p + 1, N).
+    """
+    coefs = np.full((x.shape[1] + 1, values.shape[1]), np.nan, dtype=np.float32)
+    valid = ~np.isnan(values)
+    # Only fit pixels with any valid value, e.g. not the sea or edges
+    pixels = np.flatnonzero(valid.any(axis=0))
+    if len(pixels) == 0:
+        return coefs
+    if len(pixels) < values.shape[1]:
+        values, valid = values[:, pixels], valid[:, pixels]
+    else:
+        pixels = slice(None)
+    if fit_harmonic_numba is not None and alpha != 0:
+        coefs[:, pixels] = fit_harmonic_numba(values, x, alpha, LASSO_MAX_ITER, LASSO_TOL)
+        return coefs
+    coefs_valid = coefs[:, pixels]
+    # Sums over the valid dates of all pixels, with nodata as zero,
+    # so groups only need to take their columns.
+    # They are float64, as the centered sums subtract large terms.
+    values = np.nan_to_num(values.astype(np.float64), copy=False)
+    sum_y = values.sum(axis=0)
+    sum_yy = np.einsum('ij,ij->j', values, values)
+    sum_xy = x.T @ values
+    del values
+    for valid_dates, idx in _group_by_mask(valid):
+        n_samples = valid_dates.sum()
+        # Center variables and targets for the intercept
+        x_sub = x[valid_dates]
+        x_mean = x_sub.mean(axis=0)
+        x_sub = x_sub - x_mean
+        y_mean = sum_y[idx] / n_samples
+        xy = sum_xy[:, idx] - np.outer(x_mean * n_samples, y_mean)
+        y_norm2 = np.maximum(sum_yy[idx] - n_samples * y_mean ** 2, 0)
+        if alpha == 0:
+            coefs_sub = np.linalg.lstsq(x_sub.T @ x_sub, xy, rcond=None)[0]
+        else:
+            coefs_sub = _lasso_gram(x_sub.T @ x_sub, xy, y_norm2, alpha * n_samples)
+        coefs_valid[0, idx] = y_mean - x_mean @ coefs_sub
+        coefs_valid[1:, idx] = coefs_sub
+    coefs[:, pixels] = coefs_valid
+    return coefs
+
+
+def _create_coefs(dst_path, n_cols, n_rows, n_bands, d_type, trans, proj):
+    """Create the GeoTiff of harmonic coefficients to write blocks into.
+
+    Args:
+        dst_path (str): the path of the output.
+        n_cols (int): the col size.
+        n_rows (int): the row size.
+        n_bands (int): the number of coefficients.
+        d_type (int): the gdal data type.
+        trans (tuple): the geo transform.
+        proj (str): the projection.
+
+    Returns:
+        gdal.Dataset: the output dataset.
+    """
+    # The floating point predictor only works on float types
+    predictor = 3 if d_type in (gdal.GDT_Float32, gdal.GDT_Float64) else 2
+    driver = gdal.GetDriverByName("GTiff")
+    out_data = driver.Create(dst_path, n_cols, n_rows, n_bands, d_type,
+                             options=COEFS_OPTIONS + ['PREDICTOR={}'.format(predictor)])
+    out_data.SetGeoTransform(trans)
+    out_data.SetProjection(proj)
+    return out_data
 
 
 def harmonic_fitting(tile_index, pol, config):
@@ -256,9 +464,10 @@ def harmonic_fitting(tile_index, pol, config):
 
     # process
     # Get variables and target
-    fnames = os.listdir(dir_ard)
-    fnames = list(filter(lambda fname: (".img" in fname and pol in fname and ".aux.xml" not in fname) |
-                                       ('.tif' in fname and pol in fname), fnames))
+    with os.scandir(dir_ard) as entries:
+        fnames = [entry.name for entry in entries
+                  if pol in entry.name and
+                  ((".img" in entry.name and ".aux.xml" not in entry.name) or '.tif' in entry.name)]
     fnames = _sort_fnames(fnames)
     days = _get_doy(fnames, freq, start)
     x = _getVariable(freq, days, 1 + num_pair * 2)
@@ -274,50 +483,86 @@ def harmonic_fitting(tile_index, pol, config):
     trans = img_tep.GetGeoTransform()
     proj = img_tep.GetProjection()
     d_type = img_tep.GetRasterBand(1).DataType
-    range_row = range(n_rows)
-    range_col = range(n_cols)
+    # Read whole blocks of images, so each block is decoded only once
+    block_height = img_tep.GetRasterBand(1).GetBlockSize()[1]
+    block_rows = -(-BLOCK_ROWS // block_height) * block_height
     img_tep = None
 
-    # Read all images
-    values = [read_img(fname) for fname in fnames]
-    # Define output
-    lasso_coefs = np.zeros(shape=(2 + num_pair * 2, n_rows, n_cols),
-                           dtype="float32")
-    # Do calculation
-    for row_each in range_row:
-        # read a single line from all images
-        values_row = np.array([value[row_each, :] for value in values])
-        coefs_row = np.zeros((2 + num_pair * 2, n_cols))
-        for col_each in range_col:
-            y = values_row[:, col_each]
-            x_new = x[~np.isnan(y)]
-            y_new = y[~np.isnan(y)]
-            if y_new.size != 0:
-                lasso = Lasso(max_iter=10000, alpha=alpha).fit(x_new, y_new)
-                coefficients = lasso.coef_
-                intercept = lasso.intercept_
-            else:
-                coefficients = np.empty((1 + num_pair * 2,))
-                coefficients[:] = np.nan
-                intercept = np.nan
-            coefs = np.insert(coefficients, 0, intercept)
-            coefs_row[:, col_each] = coefs
-        lasso_coefs[:, row_each, :] = coefs_row
-
-    # Write out
+    # Images are read by threads, gdal releases the GIL while reading
+    threads_number = config['parallel']['threads_number']
+    if threads_number == 'default':
+        threads_number = mp.cpu_count()
+    else:
+        threads_number = int(threads_number)
+    read_executor = FixedThreadPoolExecutor(size=max(1, min(threads_number, len(fnames))))
+
+    # Fit a block of rows of all images at a time,
+    # and write its coefficients out before the next block
     dst_path = os.path.join(dir_coefs, "tile{}_{}_harmonic.tif".format(tile_index, pol))
-    driver = gdal.GetDriverByName("GTiff")
-    out_data = driver.Create(dst_path, n_cols, n_rows, len(lasso_coefs), d_type)
-    for i in range(len(lasso_coefs)):
-        out_data.GetRasterBand(i + 1).WriteArray(lasso_coefs[i, :, :])
-        out_data.FlushCache()
-    out_data.SetGeoTransform(trans)
-    out_data.FlushCache()
-    out_data.SetProjection(proj)
+    n_coefs = 2 + num_pair * 2
+    out_data = _create_coefs(dst_path, n_cols, n_rows, n_coefs, d_type, trans, proj)
+    out_bands = [out_data.GetRasterBand(i + 1) for i in range(n_coefs)]
+    imgs = [gdal.Open(fname) for fname in fnames]
+    bands = [img.GetRasterBand(1) for img in imgs]
+    values = np.empty((len(fnames), min(block_rows, n_rows), n_cols), dtype=np.float32)
+    for row_start in range(0, n_rows, block_rows):
+        rows = min(block_rows, n_rows - row_start)
+        for i, band in enumerate(bands):
+            read_executor.submit(_read_band, band, 0, row_start, values[i, :rows])
+        read_executor.drain()
+        read_executor.raise_first()
+        coefs = _fit_harmonic(values[:, :rows].reshape(len(fnames), -1), x, alpha)
+        coefs = coefs.reshape(-1, rows, n_cols)
+        for i, out_band in enumerate(out_bands):
+            out_band.WriteArray(coefs[i], 0, row_start)
+    read_executor.close()
+    bands = None
+    imgs = None
+    del values
+    out_bands = None
     out_data.FlushCache()
     out_data = None
 
 
+def _init_br_worker(fnames, n_cols, block_rows, x, alpha):
+    """Open all images in a worker process of harmonic_fitting_br once.
+
+    Args:
+        fnames (list of str): the paths of images.
+        n_cols (int): the col size of images.
+        block_rows (int): the most rows of a block to fit.
+        x (numpy.ndarray): x variable for harmonic regression.
+        alpha (float): the alpha of lasso.
+    """
+    _br_worker['imgs'] = [gdal.Open(fname) for fname in fnames]
+    _br_worker['bands'] = [img.GetRasterBand(1) for img in _br_worker['imgs']]
+    _br_worker['values'] = np.empty((len(fnames), block_rows, n_cols), dtype=np.float32)
+    _br_worker['x'] = x
+    _br_worker['alpha'] = alpha
+    # The blocks are already fitted in parallel by processes
+    if fit_harmonic_numba is not None:
+        from numba import set_num_threads
+        set_num_threads(1)
+
+
+def _fit_block_br(block):
+    """Read and fit a block of rows of all images.
+
+    Args:
+        block (tuple): the offset of row and the number of rows.
+
+    Returns:
+        tuple: the offset of row, and its coefficients with shape (p + 1, rows, n_cols).
+    """
+    row_start, rows = block
+    values = _br_worker['values']
+    for i, band in enumerate(_br_worker['bands']):
+        _read_band(band, 0, row_start, values[i, :rows])
+    coefs = _fit_harmonic(values[:, :rows].reshape(len(values), -1),
+                          _br_worker['x'], _br_worker['alpha'])
+    return row_start, coefs.reshape(-1, rows, values.shape[2])
+
+
 def harmonic_fitting_br(tile_index, pol, config):
     """Fit harmonic regression coefficients for a tile.
 
@@ -339,13 +584,15 @@ def harmonic_fitting_br(tile_index, pol, config):
     freq = config['harmonic']["harmonic_frequency"]
     num_pair = config['harmonic']["harmonic_pairs"]
     alpha = config['harmonic']["alpha"]
+    start = config['harmonic']["date_start"]
 
     # process
     # Get variables and target
-    fnames = os.listdir(dir_ard)
-    fnames = list(filter(lambda fname: ".img" in fname and pol in fname and ".aux.xml" not in fname, fnames))
+    with os.scandir(dir_ard) as entries:
+        fnames = [entry.name for entry in entries
+                  if ".img" in entry.name and pol in entry.name and ".aux.xml" not in entry.name]
     fnames = _sort_fnames(fnames)
-    days = _get_doy(fnames, freq)
+    days = _get_doy(fnames, freq, start)
     x = _getVariable(freq, days, 1 + num_pair * 2)
     del days
 
@@ -359,70 +606,41 @@ def harmonic_fitting_br(tile_index, pol, config):
     trans = img_tep.GetGeoTransform()
     proj = img_tep.GetProjection()
     d_type = img_tep.GetRasterBand(1).DataType
-    range_row = range(n_rows)
-    range_col = range(n_cols)
+    block_height = img_tep.GetRasterBand(1).GetBlockSize()[1]
     img_tep = None
 
-    # Read all images
-    values = [read_img(fname) for fname in fnames]
-    # Define output
-    lasso_coefs = np.memmap("tmp_{}.dat".format(tile_index),
-                            dtype="float32",
-                            mode="w+",
-                            shape=(2 + num_pair * 2, n_rows, n_cols))
-
-    def _cal_row(row_each, values_row, cols):
-        # read a single line from all images
-        # values_row = np.array([value[row_each, :] for value in values_all])
-        # values_row = np.array([read_rows(fname, row_each, n_cols) for fname in fnames_all])
-        coefs_row = np.zeros((2 + num_pair * 2, n_cols))
-        for col_each in cols:  # range_col
-            y = values_row[:, col_each]
-            x_new = x[~np.isnan(y)]
-            y_new = y[~np.isnan(y)]
-            if y_new.size != 0:
-                lasso = Lasso(max_iter=10000, alpha=alpha).fit(x_new, y_new)
-                coefficients = lasso.coef_
-                intercept = lasso.intercept_
-            else:
-                coefficients = np.empty((1 + num_pair * 2,))
-                coefficients[:] = np.nan
-                intercept = np.nan
-            coefs = np.insert(coefficients, 0, intercept)
-            coefs_row[:, col_each] = coefs
-        lasso_coefs_reopen = np.memmap("tmp_{}.dat".format(tile_index),
-                                       dtype="float32",
-                                       mode="r+",
-                                       shape=(2 + num_pair * 2, n_rows, n_cols))
-        lasso_coefs_reopen[:, row_each, :] = coefs_row
-        del lasso_coefs_reopen
-
+    # Each worker reads its own blocks of rows through its own datasets,
+    # blocks are aligned to the blocks of images and small enough to balance workers
     threads_number = config['parallel']['threads_number']
     if threads_number == 'default':
         threads_number = mp.cpu_count()
     else:
         threads_number = int(threads_number)
-    mp.set_start_method("fork", force=True)
-    pool = mp.Pool(processes=threads_number)
-    pool.starmap(_cal_row, [(row_one, np.array([value[row_one, :] for value in values]), range_col)
-                            for row_one in range_row])
-    pool.close()
-    pool.join()
+    block_rows = -(-n_rows // (threads_number * 4))
+    block_rows = min(-(-block_rows // block_height) * block_height, n_rows)
+    blocks = [(row_start, min(block_rows, n_rows - row_start))
+              for row_start in range(0, n_rows, block_rows)]
 
-    # Write out
+    # Workers only fit, and this process alone writes the blocks out
     dst_path = os.path.join(dir_coefs, "tile{}_{}_harmonic.tif".format(tile_index, pol))
-    driver = gdal.GetDriverByName("GTiff")
-    out_data = driver.Create(dst_path, n_cols, n_rows, len(lasso_coefs), d_type)
-    for i in range(len(lasso_coefs)):
-        out_data.GetRasterBand(i + 1).WriteArray(lasso_coefs[i, :, :])
-        out_data.FlushCache()
-    out_data.SetGeoTransform(trans)
-    out_data.FlushCache()
-    out_data.SetProjection(proj)
+    n_coefs = 2 + num_pair * 2
+    out_data = _create_coefs(dst_path, n_cols, n_rows, n_coefs, d_type, trans, proj)
+    out_bands = [out_data.GetRasterBand(i + 1) for i in range(n_coefs)]
+    # Forkserver starts workers without the state of this process,
+    # forked workers hang in numba parallel kernels run here before.
+    start_method = 'forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn'
+    pool = mp.get_context(start_method).Pool(processes=threads_number,
+                                             initializer=_init_br_worker,
+                                             initargs=(fnames, n_cols, block_rows, x, alpha))
+    # Blocks come back in order, so they are written out sequentially
+    for row_start, coefs in pool.imap(_fit_block_br, blocks):
+        for i, out_band in enumerate(out_bands):
+            out_band.WriteArray(coefs[i], 0, row_start)
+    pool.close()
+    pool.join()
+    out_bands = None
     out_data.FlushCache()
     out_data = None
-    del lasso_coefs
-    os.unlink("tmp_{}.dat".format(tile_index))
 
 
 def s1_harmonic_each(tile_index, config_path, logger,
@@ -473,6 +691,36 @@ def s1_harmonic_each(tile_index, config_path, logger,
         shutil.rmtree(dir_ard)
 
 
+def _init_harmonic_worker(log_path):
+    """Set up a worker process of s1_harmonic_batch.
+    The worker appends logs to the log file of the parent,
+    and numba uses one thread as tiles already use all cores.
+
+    Args:
+        log_path (str): the path of log file.
+    """
+    _setup_logging(log_path, __name__, mode='a')
+    if fit_harmonic_numba is not None:
+        import numba
+        numba.set_num_threads(1)
+
+
+def _s1_harmonic_each_worker(tile_index, config_path,
+                             gf_out_format='ENVI', thread_clip=1):
+    """Fit harmonic regression coefficients for a tile in a worker process,
+    with the logger of the worker as loggers cannot be pickled.
+
+    Args:
+        tile_index (str): the index of tile.
+        config_path (str): the path of config yaml.
+        gf_out_format (str); the format of output.
+        thread_clip(int): the thread number for clipping.
+    """
+    logger = logging.getLogger(__name__)
+    s1_harmonic_each(tile_index, config_path, logger,
+                     gf_out_format, thread_clip)
+
+
 def s1_harmonic_batch(config_path, gf_out_format='ENVI',
                       initial=False, parallel_tile=False,
                       big_ram=False, thread_clip=2):
@@ -493,14 +741,9 @@ def s1_harmonic_batch(config_path, gf_out_format='ENVI',
     log_dir = join(dst_dir, 'logs')
     if not exists(log_dir):
         os.makedirs(log_dir)
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
     log_path = join(log_dir, 'sentinel1_harmonic_regression_{}.log'
                     .format(datetime.now().strftime("%d%m%Y_%H%M")))
-    log_format = "%(asctime)s::%(levelname)s::%(name)s::%(filename)s::%(lineno)d::%(message)s"
-    logging.basicConfig(filename=log_path, filemode='w',
-                        level=logging.INFO, format=log_format)
-    logger = logging.getLogger(__name__)
+    logger = _setup_logging(log_path, __name__)
 
     # Start the progress
     print('Assume that you have put all imagery in the right path.')
@@ -521,10 +764,15 @@ def s1_harmonic_batch(config_path, gf_out_format='ENVI',
         threads_number = int(threads_number)
 
     if parallel_tile:
-        harmonic_executor = FixedThreadPoolExecutor(size=threads_number)
+        # Fit tiles in processes, the fitting holds the GIL in threads.
+        # Forkserver starts workers without the state of this process.
+        start_method = 'forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn'
+        harmonic_executor = ProcessPoolExecutor(max_workers=threads_number,
+                                                mp_context=mp.get_context(start_method),
+                                                initializer=_init_harmonic_worker,
+                                                initargs=(log_path,))
         # Batch process
-        success_count = 0
-        failure_count = 0
+        futures = {}
         for i in range(0, len(sc.footprint['features'])):
             tile_index = sc.footprint['features'][i]['properties']['tile']
             if isinstance(tile_index, float):
@@ -532,17 +780,24 @@ def s1_harmonic_batch(config_path, gf_out_format='ENVI',
             else:
                 tile_index = str(tile_index)
             # tile_index = i + 1
-            if harmonic_executor.submit(s1_harmonic_each,
-                                        tile_index, config_path,
-                                        logger, gf_out_format,
-                                        thread_clip) is True:
+            future = harmonic_executor.submit(_s1_harmonic_each_worker,
+                                              tile_index, config_path,
+                                              gf_out_format, thread_clip)
+            futures[future] = tile_index
+        # await all tile finished
+        success_count = 0
+        failure_count = 0
+        for future in as_completed(futures):
+            try:
+                future.result()
                 success_count = success_count + 1
-            else:
+            # A tile without clips or ARD exits, which only fails the tile
+            except (Exception, SystemExit) as e:
+                logger.error("Failed harmonic regression of tile {}: {}"
+                             .format(futures[future], e))
                 failure_count = failure_count + 1
-        # await all tile finished
-        harmonic_executor.drain()
-        # await thread pool to stop
-        harmonic_executor.close()
+        # await process pool to stop
+        harmonic_executor.shutdown()
         logger.info("Sentinel1_harmonic_regression: finished harmonic task; "
                     "the total tile number to be processed is {}; "
                     "the success_count is {}; the failure_count is {}"
@@ -590,17 +845,17 @@ def s2_wasp(tile_id, config, logger=None):
         logger.info('Create processed path {}.'.format(level3_processed_path))
 
     # Unzip
-    fnames_all = os.listdir(processed_path)
-    fnames_all = list(filter(lambda fname: join(processed_path, fname).endswith('zip'), fnames_all))
-    zips = list(filter(lambda fname: tile_id in fname, fnames_all))
+    with os.scandir(processed_path) as entries:
+        zips = [entry.name for entry in entries
+                if entry.name.endswith('zip') and tile_id in entry.name]
     for zip_file in zips:
         _unzip_file(zip_file, processed_path)
 
     # Format tile_id
     time_series = config['wasp']['time_series']
-    fnames_all = os.listdir(processed_path)
-    fnames_all = list(filter(lambda fname: os.path.isdir(join(processed_path, fname)), fnames_all))
-    safe_path = list(filter(lambda fname: tile_id in fname, fnames_all))
+    with os.scandir(processed_path) as entries:
+        safe_path = [entry.name for entry in entries
+                     if tile_id in entry.name and entry.is_dir()]
     for i in range(len(time_series)):
         # # Has to be the full calendar, not flexible
         # if i == len(time_series) - 1:
@@ -684,22 +939,18 @@ def s2_wasp_batch(config_path):
     log_dir = join(dst_dir, 'logs')
     if not exists(log_dir):
         os.makedirs(log_dir)
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
     log_path = join(log_dir, 'sentinel2_wasp_{}.log'
                     .format(datetime.now().strftime("%d%m%Y_%H%M")))
-    log_format = "%(asctime)s::%(levelname)s::%(name)s::%(filename)s::%(lineno)d::%(message)s"
-    logging.basicConfig(filename=log_path, filemode='w',
-                        level=logging.INFO, format=log_format)
-    logger = logging.getLogger(__name__)
+    logger = _setup_logging(log_path, __name__)
 
     # WASP of sentinel-2
     # Get tile ids
-    fnames_all = os.listdir(processed_path)
-    fnames_all = list(filter(lambda fname: os.path.isdir(join(processed_path, fname)), fnames_all))
+    # One listing for both folders and zips, is_dir needs no stat on most systems
+    with os.scandir(processed_path) as entries:
+        entries = list(entries)
+    fnames_all = [entry.name for entry in entries if entry.is_dir()]
     if len(fnames_all) == 0:
-        fnames_all = os.listdir(processed_path)
-        fnames_all = list(filter(lambda fname: fname.endswith('zip'), fnames_all))
+        fnames_all = [entry.name for entry in entries if entry.name.endswith('zip')]
     tile_ids = list(set(map(lambda fname: re.search("T[0-9]{2}[A-Z]{3}", fname).group(0), fnames_all)))
 
     # Determine thread number to be used
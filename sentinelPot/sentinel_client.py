@@ -4,12 +4,39 @@ Author: Lei Song
 Maintainer: Lei Song (lsong@clarku.edu)
 """
 import os
-import geojson
+import time
 import datetime as dt
 from os.path import join
-from geojson import dump
+from geomet import wkt
 from sentinelsat import SentinelAPI
-from sentinelsat import geojson_to_wkt, read_geojson
+from sentinelsat import geojson_to_wkt
+try:
+    from sentinelsat.exceptions import LTATriggered
+except ImportError:
+    # Older sentinelsat triggers offline scenes without raising
+    class LTATriggered(Exception):
+        pass
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .fixed_thread_pool_executor import FixedThreadPoolExecutor
+from .internal_functions import _json_dumps, _read_footprint
+
+# The most queries sent to sci-hub at the same time
+QUERY_THREADS = 4
+# The largest ratio of a query to the longest query sci-hub accepts,
+# leaving room for the paging and sorting of sentinelsat
+QUERY_MAX_LENGTH_RATIO = 0.9
+# The connections kept alive to sci-hub, enough for all concurrent requests
+HTTP_POOL_SIZE = 16
+# Retry requests failed on busy sci-hub with growing waits
+HTTP_RETRY = Retry(total=5, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+# Sci-hub allows two concurrent downloads of a user
+DOWNLOAD_THREADS = 2
+# The first and the longest seconds to wait before checking offline scenes again
+LTA_POLL_INTERVAL = 60
+LTA_POLL_MAX_INTERVAL = 1800
+# The longest seconds to wait for offline scenes to come online
+LTA_MAX_WAIT = 24 * 3600
 
 
 class SentinelClient:
@@ -17,7 +44,7 @@ class SentinelClient:
     Attributes:
         date_start (dt.datetime): the start date for query.
         date_end (dt.datetime): the end date for query.
-        footprint (str): the path of geojson for query.
+        footprint (dict): the geojson for query.
         api (sentinelsat.SentinelAPI): sentinel API defined by sentinelsat.
         platformname (str): platform name for query.
             sentinel-1 or sentinel-2.
@@ -39,10 +66,15 @@ class SentinelClient:
         sc_config = config['sentinel']
         self.date_start = dt.datetime.strptime(str(sc_config['date_start']), "%Y-%m-%d")
         self.date_end = dt.datetime.strptime(str(sc_config['date_end']), "%Y-%m-%d")
-        self.footprint = read_geojson(sc_config['geojson'])
+        self.footprint = _read_footprint(sc_config['geojson'])
         self.api = SentinelAPI(config['sci_hub']['user'],
                                config['sci_hub']['password'],
                                'https://scihub.copernicus.eu/dhus')
+        # Reuse connections across requests and threads
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                              max_retries=HTTP_RETRY)
+        self.api.session.mount('https://', adapter)
+        self.api.session.mount('http://', adapter)
         self.platformname = sc_config['platformname']
         self.producttype = sc_config['producttype']
         self.sensoroperationalmode = sc_config['sensoroperationalmode']
@@ -53,6 +85,103 @@ class SentinelClient:
         self.directory_path = join(config['dirs']['dst_dir'],
                                    config['dirs']['download_path'])
         self.footprint_list = sc_config['catalog_json']
+        # The odata of scenes queried before, by scene id
+        self._odata_cache = {}
+        # The title of scenes queried before, by scene id
+        self._scene_titles = {}
+        # The titles of downloaded scenes, listed on first use
+        self._finished_titles = None
+        # The WKT and tile index of each feature of the footprint, made on first use
+        self._footprint_wkts = None
+        self._tile_indices = None
+
+    def _get_footprint_wkts(self):
+        """Get the WKT of each feature of the footprint, which is only converted once.
+
+        Returns:
+            list of str: the WKT of each feature.
+        """
+        if self._footprint_wkts is None:
+            self._footprint_wkts = [geojson_to_wkt(self.footprint, feature_number=i)
+                                    for i in range(len(self.footprint['features']))]
+        return self._footprint_wkts
+
+    def _get_tile_indices(self):
+        """Get the tile index of each feature of the footprint, which is only read once.
+
+        Returns:
+            list: the tile index of each feature.
+        """
+        if self._tile_indices is None:
+            try:
+                self._tile_indices = [feature['properties']['tile']
+                                      for feature in self.footprint['features']]
+            except KeyError as e:
+                exit("Error in reading geojson: {}".format(e))
+        return self._tile_indices
+
+    def _query_keywords(self):
+        """Get the keywords of queries except the footprint.
+
+        Returns:
+            dict: the keywords for api.query.
+        """
+        if self.platformname == 'S1':
+            return {'date': (self.date_start, self.date_end),
+                    'platformname': 'Sentinel-1',
+                    'producttype': self.producttype,
+                    'sensoroperationalmode': self.sensoroperationalmode}
+        return {'date': (self.date_start, self.date_end),
+                'platformname': 'Sentinel-2',
+                'cloudcoverpercentage': (0, self.cloudcover)}
+
+    def _query(self, ftpt):
+        """Query scenes of a footprint.
+
+        Args:
+            ftpt (str): the WKT of footprint.
+
+        Returns:
+            collections.OrderedDict: an ordered list of scenes.
+        """
+        return self.api.query(ftpt, **self._query_keywords())
+
+    def _query_union(self, ftpts):
+        """Query scenes of footprints in one query,
+        which matches scenes intersecting with any footprint.
+
+        Args:
+            ftpts (list of str): the WKT of footprints.
+
+        Returns:
+            collections.OrderedDict: an ordered list of scenes,
+            or None if the query is too long for sci-hub.
+        """
+        keywords = self._query_keywords()
+        raw = '({})'.format(' OR '.join('footprint:"Intersects({})"'.format(ftpt)
+                                        for ftpt in ftpts))
+        query = self.api.format_query(raw=raw, **keywords)
+        if self.api.check_query_length(query) > QUERY_MAX_LENGTH_RATIO:
+            return None
+        return self.api.query(raw=raw, **keywords)
+
+    def _query_all(self, ftpts):
+        """Query scenes of footprints at the same time.
+        The queries wait on sci-hub, so a few of them run in threads.
+
+        Args:
+            ftpts (list of str): the WKT of footprints.
+
+        Returns:
+            list of collections.OrderedDict: scenes of each footprint, in order of footprints.
+        """
+        query_executor = FixedThreadPoolExecutor(size=max(1, min(len(ftpts), QUERY_THREADS)))
+        for ftpt in ftpts:
+            query_executor.submit(self._query, ftpt)
+        query_executor.drain()
+        query_executor.close()
+        query_executor.raise_first()
+        return query_executor.returns
 
     def get_scenes(self):
         """Get sentinel scenes
@@ -62,47 +191,20 @@ class SentinelClient:
         Returns:
             collections.OrderedDict: an ordered list of scenes.
         """
-        # Sentinel-1 query
-        if self.platformname == 'S1':
-            ftpt = geojson_to_wkt(self.footprint)
-            all_scenes = self.api.query(ftpt,
-                                        date=(self.date_start,
-                                              self.date_end),
-                                        platformname='Sentinel-1',
-                                        producttype=self.producttype,
-                                        sensoroperationalmode=self.sensoroperationalmode)
-            # geojson with more than one features
-            if len(self.footprint['features']) > 1:
-                for i in range(1, len(self.footprint['features'])):
-                    ftpt = geojson_to_wkt(self.footprint, feature_number=i)
-                    scenes = self.api.query(ftpt,
-                                            date=(self.date_start,
-                                                  self.date_end),
-                                            platformname='Sentinel-1',
-                                            producttype=self.producttype,
-                                            sensoroperationalmode=self.sensoroperationalmode)
-                    all_scenes.update(scenes)
-        # Sentinel-2 query
-        elif self.platformname == 'S2':
-            ftpt = geojson_to_wkt(self.footprint)
-            all_scenes = self.api.query(ftpt,
-                                        date=(self.date_start,
-                                              self.date_end),
-                                        platformname='Sentinel-2',
-                                        cloudcoverpercentage=(0, self.cloudcover))
-            # geojson with more than one features
-            if len(self.footprint['features']) > 1:
-                for i in range(1, len(self.footprint['features']) - 1):
-                    ftpt = geojson_to_wkt(self.footprint, feature_number=i)
-                    scenes = self.api.query(ftpt,
-                                            date=(self.date_start,
-                                                  self.date_end),
-                                            platformname='Sentinel-2',
-                                            cloudcoverpercentage=(0, self.cloudcover))
-                    all_scenes.update(scenes)
         # Need to expand to include more
-        else:
+        if self.platformname not in ['S1', 'S2']:
             exit("Not supported producttype in this class.")
+        # Query all features, geojson may have more than one features.
+        # They are queried at once if the query is short enough,
+        # otherwise scenes shared by overlapping features are only kept once.
+        ftpts = self._get_footprint_wkts()
+        all_scenes = self._query_union(ftpts) if len(ftpts) > 1 else None
+        if all_scenes is None:
+            scenes_features = self._query_all(ftpts)
+            all_scenes = scenes_features[0]
+            for scenes in scenes_features[1:]:
+                all_scenes.update(scenes)
+        self._scene_titles.update((scene_id, item['title']) for scene_id, item in all_scenes.items())
         return all_scenes
 
     def make_footprints(self):
@@ -112,75 +214,85 @@ class SentinelClient:
         but it could be easily expanded to include more.
 
         Returns:
-            geojson.feature.FeatureCollection: the feature collection of footprint.
+            dict: the feature collection of footprint.
         """
-        ftpt = geojson_to_wkt(self.footprint)
-        try:
-            tile_index = self.footprint[0]['properties']['tile']
-        except KeyError as e:
-            exit("Error in reading geojson: {}".format(e))
-        if self.platformname == 'S1':
-            scenes = self.api.query(ftpt,
-                                    date=(self.date_start,
-                                          self.date_end),
-                                    platformname='Sentinel-1',
-                                    producttype=self.producttype,
-                                    sensoroperationalmode=self.sensoroperationalmode)
-        elif self.platformname == 'S2':
-            scenes = self.api.query(ftpt,
-                                    date=(self.date_start,
-                                          self.date_end),
-                                    platformname='Sentinel-2',
-                                    cloudcoverpercentage=(0, self.cloudcover))
         # Place to expand to include more
-        else:
+        if self.platformname not in ['S1', 'S2']:
             exit("Not supported producttype in this class.")
-        feature_collection = self.api.to_geojson(scenes)
-        for n in range(0, len(feature_collection['features'])):
-            feature_collection['features'][n]['properties']['tile_index'] = tile_index
-        feature_list = list(feature_collection['features'])
-
-        # Geojson with more than one features
-        if len(self.footprint['features']) > 1:
-            for i in range(1, len(self.footprint['features'])):
-                ftpt = geojson_to_wkt(self.footprint, feature_number=i)
-                try:
-                    tile_index = self.footprint[i]['properties']['tile']
-                except KeyError as e:
-                    exit("Error in reading geojson: {}".format(e))
-                if self.platformname == 'S1':
-                    scenes = self.api.query(ftpt,
-                                            date=(self.date_start,
-                                                  self.date_end),
-                                            platformname='Sentinel-1',
-                                            producttype=self.producttype,
-                                            sensoroperationalmode=self.sensoroperationalmode)
-                elif self.platformname == 'S2':
-                    scenes = self.api.query(ftpt,
-                                            date=(self.date_start,
-                                                  self.date_end),
-                                            platformname='Sentinel-2',
-                                            cloudcoverpercentage=(0, self.cloudcover))
-                # Need to expand to include more
-                else:
-                    exit("Not supported producttype in this class.")
-                feature_collection = self.api.to_geojson(scenes)
-                for n in range(0, len(feature_collection['features'])):
-                    feature_collection['features'][n]['properties']['tile_index'] = tile_index
-                feature_list.extend(list(feature_collection['features']))
-        feature_collections = geojson.FeatureCollection(feature_list)
-
-        # Save out the feature collection
+        tile_indices = self._get_tile_indices()
+
+        # Query all features, and mark scenes with their tiles
+        feature_list = []
+        scenes_features = self._query_all(self._get_footprint_wkts())
+        for tile_index, scenes in zip(tile_indices, scenes_features):
+            feature_list.extend(self._to_features(scenes, tile_index))
+        # A plain dict, features are not validated again
+        feature_collections = {'type': 'FeatureCollection', 'features': feature_list}
+
+        # Save out the feature collection feature by feature,
+        # so the whole document is never held as one string
         try:
-            with open(self.footprint_list, 'w') as f:
-                dump(feature_collections, f)
+            with open(self.footprint_list, 'wb') as f:
+                f.write(b'{"type": "FeatureCollection", "features": [')
+                for n, feature in enumerate(feature_list):
+                    if n > 0:
+                        f.write(b', ')
+                    f.write(_json_dumps(feature))
+                f.write(b']}')
         except OSError:
             print('Failed to save footprint.')
 
         return feature_collections
 
+    def get_odata(self, scene_id):
+        """Get the odata of a scene, which is only queried once.
+        Only the online status of a scene known to be offline is queried again,
+        as it changes once the scene is retrieved from the long term archive.
+
+        Args:
+            scene_id (str): the scene_id.
+
+        Returns:
+            dict: the odata of the scene.
+        """
+        product_info = self._odata_cache.get(scene_id)
+        if product_info is None:
+            product_info = self.api.get_product_odata(scene_id)
+            self._odata_cache[scene_id] = product_info
+        elif not product_info['Online']:
+            product_info['Online'] = self.api.is_online(scene_id)
+        return product_info
+
+    def _is_finished(self, scene_id):
+        """Check if a scene is already downloaded, without any request.
+        Only scenes with known titles, e.g. from get_scenes, can be checked.
+
+        Args:
+            scene_id (str): the scene_id.
+
+        Returns:
+            bool: True if the scene is downloaded, otherwise False.
+        """
+        title = self._scene_titles.get(scene_id)
+        if title is None:
+            return False
+        if self._finished_titles is None:
+            self._finished_titles = set(self.get_finished_titles())
+        return title in self._finished_titles
+
+    def _mark_finished(self, scene_id):
+        """Mark a scene as downloaded.
+
+        Args:
+            scene_id (str): the scene_id.
+        """
+        title = self._scene_titles.get(scene_id)
+        if title is not None and self._finished_titles is not None:
+            self._finished_titles.add(title)
+
     def download_one_scihub(self, scene_id, download=True, trigger=True):
         """Download one imagery based on scene id.
+        A scene already downloaded is not queried or downloaded again.
 
         Args:
             scene_id (str): the scene_id to download
@@ -190,10 +302,14 @@ class SentinelClient:
         Returns:
             True if online, otherwise api.download message.
         """
-        product_info = self.api.get_product_odata(scene_id)
+        if self._is_finished(scene_id):
+            return True
+        product_info = self.get_odata(scene_id)
         if product_info['Online']:
             if download:
-                return self.api.download(scene_id, directory_path=self.directory_path)
+                product_info = self.api.download(scene_id, directory_path=self.directory_path)
+                self._mark_finished(scene_id)
+                return product_info
             else:
                 return True
         else:
@@ -202,16 +318,165 @@ class SentinelClient:
             else:
                 return False
 
-    def download_all_scihub(self, scenes):
-        """Download a list of imagery
+    @staticmethod
+    def _log_error(message, logger=None):
+        """Report an error of a scene, which does not stop the other scenes.
+
+        Args:
+            message (str): the error message.
+            logger (logging.Logger): the logger object to store logs.
+        """
+        if logger is None:
+            print(message)
+        else:
+            logger.error(message)
+
+    def _download_scene(self, scene_id, logger=None):
+        """Download an online scene.
+
+        Args:
+            scene_id (str): the scene_id to download.
+            logger (logging.Logger): the logger object to store logs.
+
+        Returns:
+            tuple: the scene_id and api.download message, or None if it fails.
+        """
+        try:
+            product_info = self.api.download(scene_id, directory_path=self.directory_path)
+        except LTATriggered:
+            self._log_error("Scene {} went offline, and is triggered.".format(scene_id), logger)
+            return scene_id, None
+        except Exception as e:
+            self._log_error("Failed to download scene {}: {}".format(scene_id, e), logger)
+            return scene_id, None
+        self._mark_finished(scene_id)
+        return scene_id, product_info
+
+    def _route_scene(self, scene_id, download_executor, logger=None):
+        """Send an online scene to download, or trigger an offline scene.
+
+        Args:
+            scene_id (str): the scene_id.
+            download_executor (FixedThreadPoolExecutor): the pool of downloads.
+            logger (logging.Logger): the logger object to store logs.
+
+        Returns:
+            tuple: the scene_id and True if the scene is online, False if it is triggered,
+            or None if it fails.
+        """
+        try:
+            if self.get_odata(scene_id)['Online']:
+                download_executor.submit(self._download_scene, scene_id, logger)
+                return scene_id, True
+            self.download_one_scihub(scene_id, download=False, trigger=True)
+        except LTATriggered:
+            pass
+        except Exception as e:
+            self._log_error("Failed to get or trigger scene {}: {}".format(scene_id, e), logger)
+            return scene_id, None
+        return scene_id, False
+
+    def _poll_scene(self, scene_id, download_executor, logger=None):
+        """Send a triggered scene to download if it is online now.
+
+        Args:
+            scene_id (str): the scene_id.
+            download_executor (FixedThreadPoolExecutor): the pool of downloads.
+            logger (logging.Logger): the logger object to store logs.
+
+        Returns:
+            tuple: the scene_id and True if the scene is online, otherwise False.
+        """
+        try:
+            online = self.get_odata(scene_id)['Online']
+        except Exception as e:
+            # Check it again in the next round
+            self._log_error("Failed to check scene {}: {}".format(scene_id, e), logger)
+            return scene_id, False
+        if online:
+            download_executor.submit(self._download_scene, scene_id, logger)
+        return scene_id, online
+
+    def download_all_scihub(self, scenes, max_wait=LTA_MAX_WAIT, logger=None):
+        """Download a list of imagery.
+        Online scenes are downloaded as soon as their status is known,
+        while offline scenes are triggered and checked again
+        with growing intervals, then downloaded once they are online.
+        A scene which fails is reported and left out, without stopping the others,
+        so it could be downloaded by calling this again.
 
         Args:
             scenes (collections.OrderedDict): the Ordered dictionary of scenes.
+            max_wait (int): the longest seconds to wait for offline scenes.
+            logger (logging.Logger): the logger object to store logs.
 
         Returns:
-            api.download message.
+            dict: api.download message of each downloaded scene by scene_id.
         """
-        return self.api.download_all(scenes, directory_path=self.directory_path)
+        # Skip scenes downloaded before
+        self._scene_titles.update((scene_id, item['title']) for scene_id, item in scenes.items()
+                                  if 'title' in item)
+        scene_ids = [scene_id for scene_id in scenes.keys() if not self._is_finished(scene_id)]
+        if len(scene_ids) == 0:
+            return {}
+        download_executor = FixedThreadPoolExecutor(size=DOWNLOAD_THREADS)
+        try:
+            route_executor = FixedThreadPoolExecutor(size=min(len(scene_ids), QUERY_THREADS))
+            for scene_id in scene_ids:
+                route_executor.submit(self._route_scene, scene_id, download_executor, logger)
+            route_executor.drain()
+            route_executor.close()
+            route_executor.raise_first()
+            offline_ids = [scene_id for scene_id, online in route_executor.returns
+                           if online is False]
+
+            # Check offline scenes while online scenes are downloading,
+            # all scenes of each round at the same time
+            waited = 0
+            interval = LTA_POLL_INTERVAL
+            while len(offline_ids) > 0 and waited < max_wait:
+                time.sleep(interval)
+                waited += interval
+                interval = min(interval * 2, LTA_POLL_MAX_INTERVAL)
+                poll_executor = FixedThreadPoolExecutor(size=min(len(offline_ids), QUERY_THREADS))
+                for scene_id in offline_ids:
+                    poll_executor.submit(self._poll_scene, scene_id, download_executor, logger)
+                poll_executor.drain()
+                poll_executor.close()
+                poll_executor.raise_first()
+                offline_ids = [scene_id for scene_id, online in poll_executor.returns if not online]
+            download_executor.drain()
+        finally:
+            download_executor.close()
+        download_executor.raise_first()
+        return {scene_id: product_info for scene_id, product_info in download_executor.returns
+                if product_info is not None}
+
+    @staticmethod
+    def _to_features(scenes, tile_index):
+        """Convert scenes to geojson features marked with their tile,
+        in one pass. It does the same as api.to_geojson, but without
+        geojson objects, and keeps the coordinates as they are in the WKT.
+
+        Args:
+            scenes (OrderedDict): the scenes from api.query.
+            tile_index: the tile index of the feature queried.
+
+        Returns:
+            generator: the geojson features as dict.
+        """
+        wkt_loads = wkt.loads
+        for i, (scene_id, properties) in enumerate(scenes.items()):
+            properties = properties.copy()
+            properties['id'] = scene_id
+            geometry = wkt_loads(properties.pop('footprint'))
+            properties.pop('gmlfootprint', None)
+            # Fix "'datetime' is not JSON serializable"
+            for key, value in properties.items():
+                if isinstance(value, dt.date):
+                    properties[key] = value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            properties['tile_index'] = tile_index
+            yield {'type': 'Feature', 'id': i, 'geometry': geometry, 'properties': properties}
 
     @staticmethod
     def get_scene_ids(scenes):
@@ -235,10 +500,7 @@ class SentinelClient:
         Returns:
             list: scene_titles, a list of scene titles.
         """
-        scene_titles = []
-        for key, item in scenes.items():
-            scene_titles.append(item['title'])
-        return scene_titles
+        return [item['title'] for item in scenes.values()]
 
     def get_finished_titles(self):
         """Get finished titles.
@@ -246,8 +508,7 @@ class SentinelClient:
         Returns:
             list: a list of titles of downloaded files.
         """
-
-        fnames = os.listdir(self.directory_path)
-        fnames = list(filter(lambda fn: ".zip" in fn, fnames))
-        fnames = list(map(lambda fn: fn.replace('.zip', ''), fnames))
+        with os.scandir(self.directory_path) as entries:
+            fnames = [entry.name[:-len('.zip')] for entry in entries
+                      if entry.name.endswith('.zip')]
         return fnames
@@ -9,7 +9,10 @@ import gdown
 from os.path import join
 from sys import platform, exit
 from shutil import copyfile
-from .internal_functions import _run_cmd
+from .internal_functions import _run_cmd, _download_file
+
+# The name of sen2cor installer in its download address
+SEN2COR_RE = re.compile(r'Sen2Cor-(.+)\.run')
 
 
 def generate_config_file(dst_dir='.', logger=None):
@@ -47,10 +50,10 @@ def sen2cor_install(dst_dir=None, logger=None):
     # Detect operation system
     if platform.startswith('linux'):
         http_address = r'http://step.esa.int/thirdparties/sen2cor/2.8.0/Sen2Cor-02.08.00-Linux64.run'
-        app_name = re.search('Sen2Cor-(.+).run', http_address).group(0)
+        app_name = SEN2COR_RE.search(http_address).group(0)
     elif platform.startswith("darwin"):
         http_address = r'http://step.esa.int/thirdparties/sen2cor/2.8.0/Sen2Cor-02.08.00-Darwin64.run'
-        app_name = re.search('Sen2Cor-(.+).run', http_address).group(0)
+        app_name = SEN2COR_RE.search(http_address).group(0)
     elif platform.startswith('windows'):
         if logger is None:
             print("Windows machine: please install sen2cor manually.")
@@ -60,8 +63,7 @@ def sen2cor_install(dst_dir=None, logger=None):
 
     # Download
     fname = join(dst_dir, app_name)
-    app_dl = "curl -o {} {}".format(fname, http_address)
-    if _run_cmd(app_dl, logger):
+    if _download_file(http_address, fname, logger):
         # Install
         target_ins = join(dst_dir, "sen2cor240")
         app_ins = "chmod +x {}; sh {} --target {}".format(fname, fname, target_ins)